@@ -1,10 +1,13 @@
 from dflow.op_template import ScriptOPTemplate
+from dflow.executor import Executor
+from dflow.step import ArgoRange, ArgoLen
 from dflow.plugins.dispatcher import DispatcherExecutor
 import dflow
 
-from typing import Final, Callable, TypeVar, Optional, Union, Generic, Dict, Any, Iterable, get_args, get_origin
+from typing import Final, Callable, TypeVar, Optional, Union, Generic, Dict, Any, Iterable, List, Tuple, get_args, get_origin
 
 from dataclasses import fields, is_dataclass
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from collections import namedtuple
 from pathlib import Path
@@ -15,15 +18,18 @@ import tarfile
 import hashlib
 import inspect
 import base64
+import io
 import shutil
 import shlex
+import json
 import bz2
 import os
 
 
-from .util import resolve_ln
+from .util import resolve_ln, hash_path
+from .local_executor import LocalExecutor
 from .log import get_logger
-from . import types
+from . import types, storage
 
 logger = get_logger(__name__)
 
@@ -92,15 +98,56 @@ def parse_dflow_field(field):
     return _type, optional
 
 
-def pickle_converts(obj, pickle_module='cp', bz2_module='bz2', base64_module='base64'):
+def pickle_converts(obj, pickle_module='cp', bz2_module='bz2', base64_module='base64',
+                    blobs: Optional[Dict[str, bytes]] = None, blob_min_size: int = 4096):
     """
     convert an object to its pickle string form
+
+    :param blobs: if provided, the attributes of obj whose pickle is larger than blob_min_size
+        are offloaded to it as compressed pickle keyed by the sha256 of the pickle,
+        so that they can be shared by steps. The generated code then requires `__BlobUnpickler`
+        and `io` to be defined to load them back.
     """
-    obj_pkl = cp.dumps(obj, protocol=cp.DEFAULT_PROTOCOL)
+    if blobs is None:
+        obj_pkl = cp.dumps(obj, protocol=cp.DEFAULT_PROTOCOL)
+    else:
+        obj_pkl = _dumps_with_blobs(obj, blobs, blob_min_size)
     compress_level = 5 if len(obj_pkl) > 4096 else 1
     compressed = bz2.compress(obj_pkl, compress_level)
     obj_b64 = base64.b64encode(compressed).decode('ascii')
-    return f'{pickle_module}.loads({bz2_module}.decompress({base64_module}.b64decode({repr(obj_b64)})))'
+    obj_pkl_expr = f'{bz2_module}.decompress({base64_module}.b64decode({repr(obj_b64)}))'
+    if blobs is None:
+        return f'{pickle_module}.loads({obj_pkl_expr})'
+    return f'__BlobUnpickler(io.BytesIO({obj_pkl_expr})).load()'
+
+
+class _BlobPickler(cp.Pickler):
+    """
+    A pickler that replaces the selected objects with their keys in blobs.
+    """
+
+    def __init__(self, file, offloads: Dict[int, str]):
+        super().__init__(file, protocol=cp.DEFAULT_PROTOCOL)
+        self._offloads = offloads
+
+    def persistent_id(self, obj):
+        return self._offloads.get(id(obj))
+
+
+def _dumps_with_blobs(obj, blobs: Dict[str, bytes], blob_min_size: int) -> bytes:
+    offloads: Dict[int, str] = {}
+    # only the attributes of callable object are offloaded, e.g. the config of step functions
+    if not inspect.isroutine(obj) and not inspect.isclass(obj):
+        for value in getattr(obj, '__dict__', {}).values():
+            value_pkl = cp.dumps(value, protocol=cp.DEFAULT_PROTOCOL)
+            if len(value_pkl) < blob_min_size:
+                continue
+            key = hashlib.sha256(value_pkl).hexdigest()
+            blobs[key] = bz2.compress(value_pkl, 5)
+            offloads[id(value)] = key
+    buf = io.BytesIO()
+    _BlobPickler(buf, offloads).dump(obj)
+    return buf.getvalue()
 
 
 _ParsedField = namedtuple('_ParseField', ['name', 'type', 'optional', 'value'])
@@ -233,6 +280,7 @@ def bash_build_template(py_fn: Callable,
 
 
 _PythonTemplate = namedtuple('_PythonStep', ['source', 'fn_str', 'script_path', 'pkg_dir',
+                                             'blob_dir', 'blobs',
                                              'dflow_input_parameters',
                                              'dflow_input_artifacts',
                                              'dflow_output_parameters',
@@ -245,9 +293,16 @@ def python_build_template(py_fn: Callable,
                           setup_script: str = '',
                           python_cmd: str = 'python3',
                           default_archive: Optional[str] = 'default',
-                          eof: str = '__EOF__') -> _PythonTemplate:
+                          eof: str = '__EOF__',
+                          in_process: bool = True,
+                          blob_min_size: Optional[int] = 4096) -> _PythonTemplate:
     """
     build python template from a python function
+
+    :param in_process: run the function script in the bootstrap process with runpy
+        instead of starting another interpreter, the exit code and output parameters are the same.
+    :param blob_min_size: the attributes of the function object whose pickle is larger than it
+        are offloaded to blobs, which should be placed in blob_dir by the caller, set to None to inline them all.
     """
     sig = inspect.signature(py_fn)
     assert len(sig.parameters) == 1, f'{py_fn} should have only one parameter'
@@ -258,6 +313,7 @@ def python_build_template(py_fn: Callable,
     pkg_dir = os.path.join(base_dir, 'python/pkg')
     args_file = os.path.join(fn_dir, 'args.json')
     script_path = os.path.join(fn_dir, 'script.py')
+    blob_dir = os.path.join(fn_dir, 'blob')
     output_parameters_dir = os.path.join(base_dir, 'output-parameters')
     input_artifacts_dir = os.path.join(base_dir, 'input-artifacts')
     output_artifacts_dir = os.path.join(base_dir, 'output-artifacts')
@@ -275,7 +331,7 @@ def python_build_template(py_fn: Callable,
         setup_script,
         '',
         f'{python_cmd}  << {eof}',
-        'import os, json, tarfile',
+        'import os, json, tarfile, tempfile, hashlib, shutil',
         f'base_dir = {repr(base_dir)}',
         f'fn_dir = {repr(fn_dir)}',
         f'pkg_dir = {repr(pkg_dir)}',
@@ -305,14 +361,14 @@ def python_build_template(py_fn: Callable,
             source.append(f'args[{repr(f.name)}] = {repr(path)}')
             artifact = meta
             if not isinstance(artifact, dflow.InputArtifact):
-                artifact = dflow.InputArtifact(path=path, archive=default_archive)  # type: ignore
+                artifact = dflow.InputArtifact(path=path, archive=default_archive, optional=f.optional)  # type: ignore
             dflow_input_artifacts[f.name] = artifact
         elif meta == types.Symbol.OUTPUT_ARTIFACT or isinstance(meta, dflow.OutputArtifact):
             path = os.path.join(output_artifacts_dir, f.name)
             source.append(f'args[{repr(f.name)}] = {repr(path)}')
             artifact = meta
             if not isinstance(artifact, dflow.OutputArtifact):
-                artifact = dflow.OutputArtifact(path=path, archive=default_archive)  # type: ignore
+                artifact = dflow.OutputArtifact(path=path, archive=default_archive, optional=f.optional)  # type: ignore
             dflow_output_artifacts[f.name] = artifact
 
     source.extend([
@@ -321,25 +377,62 @@ def python_build_template(py_fn: Callable,
         'with open(args_file, "w") as fp:',
         '    json.dump(args, fp, indent=2)',
         '',
-        '# unpack tarball in pkg_dir',
-        'for file in os.listdir(pkg_dir):',
-        '    if file.endswith(".tar.bz2"):',
+        '# extract tarballs once into a node local cache, which is keyed by their names that contain content hash,',
+        '# fallback to extract them in pkg_dir if the cache is not writable',
+        'tarballs = sorted(file for file in os.listdir(pkg_dir) if file.endswith(".tar.bz2"))',
+        f'pkg_cache_dir = os.environ.get({repr(PKG_CACHE_DIR_ENV)})',
+        'pkg_cache_dir = pkg_cache_dir or os.path.join(tempfile.gettempdir(), "dflow-galaxy-pkg")',
+        'env_dir = os.path.join(pkg_cache_dir, hashlib.sha256(",".join(tarballs).encode()).hexdigest()[:16])',
+        'if not os.path.isdir(env_dir):',
+        '    try:',
+        '        os.makedirs(pkg_cache_dir, exist_ok=True)',
+        '        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=pkg_cache_dir)',
+        '    except OSError:',
+        '        env_dir = tmp_dir = pkg_dir',
+        '    for file in tarballs:',
         '        with tarfile.open(os.path.join(pkg_dir, file), "r:bz2") as tar_fp:',
-        '            tar_fp.extractall(pkg_dir)',
+        '            tar_fp.extractall(tmp_dir)',
+        '    if tmp_dir != env_dir:',
+        '        try:',
+        '            os.rename(tmp_dir, env_dir)',
+        '        except OSError:  # extracted by another step at the same time',
+        '            shutil.rmtree(tmp_dir, ignore_errors=True)',
         '',
-        '# insert pkg_dir to PYTHONPATH',
-        'os.environ["PYTHONPATH"] = pkg_dir + ":" + os.environ.get("PYTHONPATH", "")',
-        f'exit_code = os.system(f"{python_cmd} {{script_path}} {{args_file}}")',
+        '# insert env_dir to PYTHONPATH',
+        'os.environ["PYTHONPATH"] = env_dir + ":" + os.environ.get("PYTHONPATH", "")',
+    ])
+    if in_process:
+        source.extend([
+            'import runpy, sys',
+            'sys.path.insert(0, env_dir)',
+            'sys.argv = [script_path, args_file, output_parameters_dir]',
+            'try:',
+            '    runpy.run_path(script_path, run_name="__main__")',
+            '    exit_code = 0',
+            'except SystemExit as e:',
+            '    exit_code = e.code or 0',
+        ])
+    else:
+        source.append(f'exit_code = os.system(f"{python_cmd} {{script_path}} {{args_file}} {{output_parameters_dir}}")')
+    source.extend([
         'assert exit_code == 0, f"python script failed with exit code {exit_code}"',
         eof,
     ])
 
+    blobs: Dict[str, bytes] = {}
     fn_str = [
         'import cloudpickle as cp',
-        'import base64, json, bz2, os, sys',
+        'import base64, json, bz2, io, os, sys, pickle',
+        '',
+        '# load the offloaded objects from the blobs next to this script',
+        'class __BlobUnpickler(pickle.Unpickler):',
+        '    def persistent_load(self, pid):',
+        '        blob_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blob", pid)',
+        '        with open(blob_file, "rb") as fp:',
+        '            return cp.loads(bz2.decompress(fp.read()))',
         '',
         '# deserialize function',
-        f'__fn = {pickle_converts(py_fn)}',
+        f'__fn = {pickle_converts(py_fn, blobs=None if blob_min_size is None else blobs, blob_min_size=blob_min_size or 0)}',
         '',
         '# deserialize args type',
         f'__ArgsType = {pickle_converts(args_type)}',
@@ -352,16 +445,17 @@ def python_build_template(py_fn: Callable,
         '# handle the return value',
     ]
 
+    # the output parameters dir is passed as argument so that the script is independent of base_dir
     for f, v in iter_python_step_return(return_type):
         path = os.path.join(output_parameters_dir, f.name)
         if _is_str_type(f.type.__origin__):
             fn_str.extend([
-                f'with open({repr(path)}, "w") as fp:',
+                f'with open(os.path.join(sys.argv[2], {repr(f.name)}), "w") as fp:',
                 f'    fp.write(str(__ret.{f.name}))'
             ])
         else:
             fn_str.extend([
-                f'with open({repr(path)}, "w") as fp:',
+                f'with open(os.path.join(sys.argv[2], {repr(f.name)}), "w") as fp:',
                 f'    json.dump(__ret.{f.name}, fp)'
             ])
         dflow_output_parameters[f.name] = dflow.OutputParameter(value_from_path=path)
@@ -371,6 +465,8 @@ def python_build_template(py_fn: Callable,
                            fn_str='\n'.join(fn_str),
                            script_path=script_path,
                            pkg_dir=pkg_dir,
+                           blob_dir=blob_dir,
+                           blobs=blobs,
                            dflow_input_parameters=dflow_input_parameters,
                            dflow_input_artifacts=dflow_input_artifacts,
                            dflow_output_parameters=dflow_output_parameters,
@@ -383,6 +479,19 @@ def _s3_copy_fn(src, *args, **kwargs):
     else:
         shutil.copy2(src, *args, **kwargs)
 
+_UPLOAD_MANIFEST_KEY = 'build-in/upload-manifest.json'
+# env var to set the dir to cache extracted python packages in remote, default to a dir in the system temp dir
+PKG_CACHE_DIR_ENV = 'DFLOW_GALAXY_PKG_CACHE_DIR'
+_MEMO_KEY_PARAM = '__memo_key__'
+
+
+# large resources that are only used when building workflows,
+# they can still be shipped to a step by adding `<pkg>/<path>` to its pkgs
+DEFAULT_PKG_EXCLUDES: Dict[str, List[str]] = {
+    'dflow_galaxy': ['res/cp2k_data'],
+}
+
+
 class DFlowBuilder:
     """
     A type friendly wrapper to build a DFlow workflow.
@@ -395,7 +504,12 @@ class DFlowBuilder:
                  debug=False,
                  container_base_dir: str = '/tmp/dflow-builder',
                  allow_abs_s3_url=False,
-                 s3_debug_fn = _s3_copy_fn):
+                 s3_debug_fn = _s3_copy_fn,
+                 cache_dir: str = '~/.cache/dflow-galaxy',
+                 memoize: bool = False,
+                 debug_runner: str = 'dflow',
+                 pkg_excludes: Optional[Dict[str, List[str]]] = None,
+                 python_in_process: bool = True):
         """
         :param name: The name of the workflow.
         :param s3_prefix: The base prefix of the S3 bucket to store data generated by the workflow.
@@ -407,6 +521,19 @@ class DFlowBuilder:
         :param container_base_dir: The base directory to mapping resources in remote container.
         :param allow_abs_s3_url: If True, allow absolute s3 url in input artifacts
         :param s3_debug_fn: The function to upload file to S3 under debug mode.
+        :param cache_dir: The local directory to cache build artifacts, e.g. python package tarballs.
+        :param memoize: If True, skip the steps that have been completed with the same fingerprint,
+            which is computed from the template, the input parameters and the digests of the input artifacts.
+        :param debug_runner: The runner to use in debug mode, 'dflow' to use the debug mode of dflow,
+            'local' to run steps with the builtin local executor, which runs parallel steps
+            and the items of `with_param` in a process pool. Unlike dflow, the local executor
+            always stores artifacts in the local storage and doesn't support `debug_s3`,
+            and it stages the inputs of tasks from the storage with `debug_copy_method` directly,
+            so a task that writes to its inputs modifies the stored artifacts unless it is 'copy'.
+        :param pkg_excludes: The paths relative to the package dir to exclude from the package tarballs,
+            default to DEFAULT_PKG_EXCLUDES.
+        :param python_in_process: If True, the function of python step is run in the bootstrap process,
+            otherwise in a new python process.
         """
         if debug:
             dflow.config['mode'] = 'debug'
@@ -414,19 +541,31 @@ class DFlowBuilder:
             s3_prefix = s3_prefix.lstrip('/')
 
         assert container_base_dir.startswith('/tmp'), 'dflow: container_base_dir must start with /tmp'
+        assert debug_runner in ('local', 'dflow'), f'unsupported debug runner {debug_runner}'
 
         self.name: Final[str] = name
         self.workflow: Final[dflow.Workflow] = dflow.Workflow(name=name)
         self.s3_base_prefix: Final[str] = s3_prefix
         self.container_base_dir: Final[str] = container_base_dir
+        self.cache_dir: Final[str] = os.path.expanduser(cache_dir)
 
         self._default_archive = default_archive
         self._default_executor = default_executor
         self._default_setup_script = default_setup_script
-        self._python_fns: Dict[Callable, str] = {}
+        self._python_fns: Dict[str, str] = {}
         self._python_pkgs: Dict[str, str] = {}
-        self._bash_scripts: Dict[Callable, str] = {}
+        self._python_blobs: Dict[str, str] = {}
+        self._pkg_excludes = DEFAULT_PKG_EXCLUDES if pkg_excludes is None else pkg_excludes
+        self._python_in_process = python_in_process
+        self._templates: Dict[str, ScriptOPTemplate] = {}
+        self._rendered_templates: Dict[str, ScriptOPTemplate] = {}
         self._s3_cache: Dict[str, str] = {}
+        self._upload_manifest: Optional[storage.UploadManifest] = None
+        self._step_fingerprints: Dict[str, str] = {}
+        self._artifact_digests: Dict[str, str] = {}
+        self._memoize = memoize
+        self._debug_runner = debug_runner
+        self._step_groups: List[List[dflow.Step]] = []
         self._s3_debug_fn = s3_debug_fn
         self._allow_abs_s3_url = allow_abs_s3_url
         self._debug = debug
@@ -464,16 +603,93 @@ class DFlowBuilder:
 
         :param path: The local file path.
         :param keys: The keys of the S3 object.
+        :param cache: If True, skip the upload if the same content has been uploaded to the key,
+            the content hash of uploaded paths are recorded in a manifest that persists across runs.
+        """
+        return self.s3_upload_many([(path, key)], cache=cache, max_workers=1)[0]
+
+    def s3_upload_many(self, items: Iterable[Tuple[Union[os.PathLike, str], str]],
+                       cache: bool = False, max_workers: int = 8) -> List[str]:
+        """
+        upload many local files or directories to S3 concurrently.
+
+        :param items: The (path, key) pairs to upload.
+        :param cache: If True, skip the upload if the same content has been uploaded to the key.
+        :param max_workers: The max number of concurrent uploads.
+        :return: The keys of the uploaded objects, in the same order as the input.
         """
-        if not isinstance(path, str):
-            path = str(path)
+        items = [(str(path), self.s3_prefix(key)) for path, key in items]
+        pending = [(path, prefix) for path, prefix in items
+                   if not (cache and prefix in self._s3_cache)]
+
+        content_hashes = {}
+        if cache and pending:
+            manifest = self._get_upload_manifest()
+            for path, prefix in list(pending):
+                content_hashes[prefix] = hash_path(path)
+                key = manifest.get(prefix, content_hashes[prefix])
+                if key is not None and storage.exists(key):
+                    logger.info(f'content of {path} has been uploaded to {key}, skip upload')
+                    self._s3_cache[prefix] = key
+                    pending.remove((path, prefix))
+
+        if not pending:
+            keys = []
+        elif storage.is_local_mode():
+            def _upload(item):
+                path, prefix = item
+                return dflow.upload_s3(path, prefix, debug_func=self._s3_debug_fn)  # type: ignore
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                keys = list(executor.map(_upload, pending))
+        else:
+            keys = storage.upload_files([(path, storage.resolve_key(prefix)) for path, prefix in pending],
+                                        max_workers=max_workers)
+
+        for (_path, prefix), key in zip(pending, keys):
+            self._s3_cache[prefix] = key
+            if prefix in content_hashes:
+                self._get_upload_manifest().set(prefix, content_hashes[prefix], key)
+        if content_hashes and pending:
+            self._save_upload_manifest()
+        return [self._s3_cache[prefix] for _path, prefix in items]
+
+    def s3_exists(self, key: str) -> Optional[str]:
+        """
+        Check if an object exists in S3.
 
-        prefix = self.s3_prefix(key)
-        if cache and prefix in self._s3_cache:
-            return self._s3_cache[prefix]
-        # FIXME: the type of dflow.upload_s3 is not correct
-        self._s3_cache[prefix] = dflow.upload_s3(path, prefix, debug_func=self._s3_debug_fn)  # type: ignore
-        return self._s3_cache[prefix]
+        :param key: The key of the S3 object.
+        :return: The resolved key if the object exists, otherwise None.
+        """
+        resolved_key = storage.resolve_key(self.s3_prefix(key))
+        if storage.exists(resolved_key):
+            return resolved_key
+        return None
+
+    def _get_upload_manifest(self):
+        """
+        Load the upload manifest from local cache and the mirror in S3.
+        """
+        if self._upload_manifest is None:
+            prefix_hash = hashlib.sha256(self.s3_prefix('').encode()).hexdigest()
+            manifest = storage.UploadManifest(os.path.join(self.cache_dir, 'upload-manifest', f'{prefix_hash}.json'))
+            manifest.load()
+            key = self.s3_exists(_UPLOAD_MANIFEST_KEY)
+            if key is not None:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    path = os.path.join(tmp_dir, 'manifest.json')
+                    storage.download_file(key, path)
+                    manifest.load(path)
+            self._upload_manifest = manifest
+        return self._upload_manifest
+
+    def _save_upload_manifest(self):
+        manifest = self._get_upload_manifest()
+        manifest.dump()
+        key = self.s3_prefix(_UPLOAD_MANIFEST_KEY)
+        if storage.is_local_mode():
+            dflow.upload_s3(manifest.path, key, debug_func=self._s3_debug_fn)  # type: ignore
+        else:
+            storage.upload_files([(manifest.path, storage.resolve_key(key))])
 
     def s3_dump(self, data: Union[bytes, str], key: str) -> str:
         """
@@ -493,6 +709,7 @@ class DFlowBuilder:
         Add a step to the workflow.
         """
         self.workflow.add(step.df_step)
+        self._step_groups.append([step.df_step])
 
     def add_steps(self, steps: Steps):
         """
@@ -500,11 +717,14 @@ class DFlowBuilder:
         """
         df_steps = _to_dflow_steps(steps)
         self.workflow.add(df_steps)
+        self._step_groups.append(list(_flatten(df_steps)))
 
     def run(self, raise_on_failed=True):
         """
         Run the workflow.
         """
+        if self._debug and self._debug_runner == 'local':
+            return self._run_local(raise_on_failed)
         self.workflow.submit()
         try:
             self.workflow.wait()
@@ -514,11 +734,26 @@ class DFlowBuilder:
             if self._debug:
                 resolve_ln(self.s3_base_prefix, mv=True)
 
+    def _run_local(self, raise_on_failed=True):
+        if dflow.config['debug_s3']:
+            raise ValueError('debug_s3 is not supported by the local debug runner')
+        executor = LocalExecutor(f'{self.name}-{uuid4().hex[:8]}',
+                                 container_base_dir=self.container_base_dir,
+                                 memo_dir=storage.resolve_key(self.s3_prefix('build-in/memo')),
+                                 max_workers=dflow.config['debug_pool_workers'],
+                                 copy_method=dflow.config['debug_copy_method'])
+        try:
+            if not executor.run(self._step_groups) and raise_on_failed:
+                raise RuntimeError(f'workflow {self.name} failed')
+        finally:
+            resolve_ln(self.s3_base_prefix, mv=True)
+
     def make_bash_step(self, fn: Callable[[T_ARGS], types.ListStr], /,
                        uid: Optional[str] = None,
                        setup_script: str = '',
                        with_param: Any = None,
                        executor: Optional[DispatcherExecutor] = None,
+                       memoize: Optional[bool] = None,
                        ) -> Callable[[T_ARGS], Step[T_ARGS, None]]:
         """
         Make a bash step from python function.
@@ -526,17 +761,21 @@ class DFlowBuilder:
         :param fn: The python function to generate the bash script.
         :param with_param: The parameter to pass to the step.
         :param setup_script: The bash script to run at the beginning of the step.
+        :param memoize: Override the memoize option of the builder.
         :return: A function to run the step.
         """
         if uid is None:
             uid = str(uuid4())
         if not setup_script:
             setup_script = self._default_setup_script
+        if memoize is None:
+            memoize = self._memoize
         def wrapped_fn(args: T_ARGS):
-            template = self._create_bash_template(fn, uid=uid, setup_script=setup_script)
+            template = self._create_bash_template(fn, setup_script=setup_script, memoize=memoize)
             return self._build_step('bash-step-' + uid, args, template,
                                     with_param=with_param,
-                                    executor=executor)
+                                    executor=executor,
+                                    memoize=memoize)
         return wrapped_fn
 
     def make_python_step(self, fn: Callable[[T_ARGS], T_RESULT], /,
@@ -545,6 +784,7 @@ class DFlowBuilder:
                          with_param: Any = None,
                          pkgs: Optional[Iterable[str]] = None,
                          executor: Optional[DispatcherExecutor] = None,
+                         memoize: Optional[bool] = None,
                          ) -> Callable[[T_ARGS], Step[T_ARGS, T_RESULT]]:
         """
         Make a python step.
@@ -553,10 +793,13 @@ class DFlowBuilder:
         :param with_param: The parameter to pass to the step.
         :param setup_script: The bash script to run at the beginning of the step.
         :param pkgs: The python packages to install in the step.
+            A path in a package, e.g. `dflow_galaxy/res/cp2k_data`, can be used to ship the excluded data.
+        :param memoize: Override the memoize option of the builder.
         :return: A function to run the step.
 
         Due to the design flaw of the Argo Workflow that the s3 key cannot be set as step arguments,
-        for each step a dedicated template have to be created.
+        the s3 keys of output artifacts are passed to the template as hidden input parameters,
+        so that steps with identical script can share the same template.
         Ref: https://github.com/argoproj/argo-workflows/discussions/12606#discussioncomment-8358302
         """
         if uid is None:
@@ -565,46 +808,52 @@ class DFlowBuilder:
             pkgs = ['dflow_galaxy', 'dflow', 'ai2_kit', 'jsonpickle']
         if not setup_script:
             setup_script = self._default_setup_script
+        if memoize is None:
+            memoize = self._memoize
 
         def wrapped_fn(args: T_ARGS):
-            template = self._create_python_template(fn, uid=uid, pkgs=pkgs, setup_script=setup_script)
+            template = self._create_python_template(fn, pkgs=pkgs, setup_script=setup_script, memoize=memoize)
             return self._build_step('py-step-' + uid, args, template,
                                     with_param=with_param,
-                                    executor=executor)
+                                    executor=executor,
+                                    memoize=memoize)
         return wrapped_fn
 
-    def _create_bash_template(self, fn: Callable, uid: str,
+    def _create_bash_template(self, fn: Callable,
                               setup_script: str = '',
-                              bash_cmd: str = 'bash',):
+                              bash_cmd: str = 'bash',
+                              memoize: bool = False):
         _template = bash_build_template(fn,
                                         base_dir=self.container_base_dir,
                                         setup_script=setup_script,
                                         default_archive=self._default_archive)
         dflow_template = ScriptOPTemplate(
-            name='bash-template-' + uid,
+            name='bash-template',
             command=bash_cmd,
             script=_template.source,
         )
         dflow_template.inputs.parameters = _template.dflow_input_parameters
         dflow_template.inputs.artifacts = _template.dflow_input_artifacts
         dflow_template.outputs.artifacts = _template.dflow_output_artifacts
-        return dflow_template
+        return self._register_template(dflow_template, memoize=memoize)
 
-    def _create_python_template(self, fn: Callable, uid: str,
+    def _create_python_template(self, fn: Callable,
                                 setup_script: str = '',
                                 python_cmd: str = 'python3',
                                 bash_cmd: str = 'bash',
                                 pkgs: Optional[Iterable[str]] = None,
+                                memoize: bool = False,
                                 ):
         if pkgs is None:
             pkgs = []
         _template = python_build_template(fn, base_dir=self.container_base_dir,
                                           python_cmd=python_cmd,
                                           setup_script=setup_script,
-                                          default_archive=self._default_archive)
+                                          default_archive=self._default_archive,
+                                          in_process=self._python_in_process)
         fn_hash = hashlib.sha256(_template.fn_str.encode()).hexdigest()
         dflow_template = ScriptOPTemplate(
-            name='py-template-' + uid,
+            name='py-template',
             command=bash_cmd,
             script=_template.source,
         )
@@ -618,38 +867,108 @@ class DFlowBuilder:
             source=dflow.S3Artifact(key=key),
             path=_template.script_path,
         )
+        # download the offloaded objects of the function, which are shared by the steps
+        for blob_hash, blob in _template.blobs.items():
+            key = self._add_python_blob(blob_hash, blob)
+            dflow_template.inputs.artifacts[f'__blob-{blob_hash[:16]}__'] = dflow.InputArtifact(
+                source=dflow.S3Artifact(key=key),
+                path=os.path.join(_template.blob_dir, blob_hash),
+            )
         # download python packages
         for pkg in pkgs:
             key = self._add_python_pkg(pkg)
-            dflow_template.inputs.artifacts[pkg] = dflow.InputArtifact(
+            dflow_template.inputs.artifacts[_pkg_bundle_name(pkg)] = dflow.InputArtifact(
                 source=dflow.S3Artifact(key=key),
-                path=os.path.join(_template.pkg_dir, f'{pkg}.tar.bz2'),
+                # keep the content hash in the file name, which is used as the key of extraction cache
+                path=os.path.join(_template.pkg_dir, os.path.basename(key)),
             )
-        return dflow_template
+        return self._register_template(dflow_template, memoize=memoize)
+
+    def _register_template(self, dflow_template: ScriptOPTemplate, memoize: bool = False):
+        """
+        Register a template and return the existed one if they share the same fingerprint.
+
+        The s3 keys of the output artifacts are different for each step,
+        so they are set to be rendered from the input parameters of the template.
+        So does the memoize key.
+        """
+        for name, artifact in dflow_template.outputs.artifacts.items():
+            param = _save_key_param(name)
+            dflow_template.inputs.parameters[param] = dflow.InputParameter(name=param)
+            artifact.save = [dflow.S3Artifact(key=f'{{{{inputs.parameters.{param}}}}}')]
+        if memoize:
+            dflow_template.inputs.parameters[_MEMO_KEY_PARAM] = dflow.InputParameter(name=_MEMO_KEY_PARAM)
+            dflow_template.memoize_key = f'{{{{inputs.parameters.{_MEMO_KEY_PARAM}}}}}'
+
+        fingerprint = _template_fingerprint(dflow_template)
+        if fingerprint not in self._templates:
+            dflow_template.name = f'{dflow_template.name}-{fingerprint[:16]}'
+            self._templates[fingerprint] = dflow_template
+        return self._templates[fingerprint]
 
     def _add_python_fn(self, fn, fn_str: str, fn_hash: str):
-        if fn not in self._python_fns:
+        if fn_hash not in self._python_fns:
             fn_prefix = self.s3_dump(fn_str, f'build-in/python/fn/{fn_hash}')
             logger.info(f'upload {fn} to {fn_prefix}')
-            self._python_fns[fn] = fn_prefix
-        return self._python_fns[fn]
+            self._python_fns[fn_hash] = fn_prefix
+        return self._python_fns[fn_hash]
+
+    def _add_python_blob(self, blob_hash: str, blob: bytes):
+        """
+        Add a blob of python function, which is content addressed by its hash
+        and uploaded only if it doesn't exist in S3.
+        """
+        if blob_hash not in self._python_blobs:
+            key = f'build-in/python/blob/{blob_hash}'
+            resolved_key = self.s3_exists(key)
+            if resolved_key is None:
+                resolved_key = self.s3_dump(blob, key)
+                logger.info(f'upload python blob {blob_hash} ({len(blob)} bytes) to {resolved_key}')
+            self._python_blobs[blob_hash] = resolved_key
+        return self._python_blobs[blob_hash]
 
     def _add_python_pkg(self, pkg: str):
         """
         Add a python package to the workflow.
-        """
-        # Find the path of target package,
-        # then create a temporary tarball and upload it to s3
 
+        The tarball is content addressed by the hash of the package source,
+        so it is built only once and uploaded only if it doesn't exist in S3.
+
+        :param pkg: name of the package, or a path in the package, e.g. `dflow_galaxy/res/cp2k_data`,
+            which will be extracted to the same place as the package.
+            The paths in pkg_excludes are excluded if pkg is a package.
+        """
         if pkg not in self._python_pkgs:
-            pkg_path = os.path.dirname(__import__(pkg).__file__)
-            with tempfile.NamedTemporaryFile(suffix='.tar.bz2') as fp:
-                with tarfile.open(fp.name, 'w:bz2') as tar_fp:
-                    tar_fp.add(pkg_path, arcname=os.path.basename(pkg_path), filter=_filter_pyc_files)
-                fp.flush()
-                key = self.s3_upload(Path(fp.name), f'build-in/python/pkg/{pkg}.tar.bz2')
-                logger.info(f'upload python pkg {pkg} to {key}')
-                self._python_pkgs[pkg] = key
+            pkg_name, _, sub_path = pkg.partition('/')
+            pkg_path = os.path.dirname(__import__(pkg_name).__file__)
+            src_path = os.path.join(pkg_path, sub_path) if sub_path else pkg_path
+            excludes = [] if sub_path else self._pkg_excludes.get(pkg_name, [])
+            include = lambda path: _is_not_pyc_file(path) and not _is_excluded(path, excludes)
+
+            pkg_hash = hash_path(src_path, include=include)
+            bundle_name = _pkg_bundle_name(pkg)
+            tarball = os.path.join(self.cache_dir, 'python/pkg', f'{bundle_name}-{pkg_hash}.tar.bz2')
+            if not os.path.exists(tarball):
+                os.makedirs(os.path.dirname(tarball), exist_ok=True)
+                tmp_tarball = f'{tarball}.{uuid4()}.tmp'
+                arcname = os.path.join(os.path.basename(pkg_path), sub_path).rstrip('/')
+
+                def _filter(tarinfo):
+                    return tarinfo if include(os.path.relpath(tarinfo.name, arcname)) else None
+
+                with tarfile.open(tmp_tarball, 'w:bz2') as tar_fp:
+                    tar_fp.add(src_path, arcname=arcname, filter=_filter)
+                os.replace(tmp_tarball, tarball)
+                logger.info(f'build python pkg {pkg} to {tarball}')
+
+            key = f'build-in/python/pkg/{bundle_name}-{pkg_hash}.tar.bz2'
+            resolved_key = self.s3_exists(key)
+            if resolved_key is None:
+                resolved_key = self.s3_upload(tarball, key)
+                logger.info(f'upload python pkg {pkg} to {resolved_key}')
+            else:
+                logger.info(f'python pkg {pkg} already exists in {resolved_key}, skip upload')
+            self._python_pkgs[pkg] = resolved_key
         return self._python_pkgs[pkg]
 
     def _ensure_artifact(self, url_or_obj: DFLOW_ARTIFACT) -> DFLOW_ARTIFACT:
@@ -670,23 +989,50 @@ class DFlowBuilder:
 
     def _build_step(self, name: str, args: T_ARGS, template,
                     with_param: Any=None,
-                    executor: Optional[DispatcherExecutor] = None):
+                    executor: Optional[DispatcherExecutor] = None,
+                    memoize: bool = False):
         if executor is None:
             executor = self._default_executor
+        if executor is not None:
+            executor = _SharedRenderExecutor(executor, self._rendered_templates)
 
         parameters = {}
         artifacts = {}
+        output_keys = {}
         for f in iter_python_step_args(args):
             meta = f.type.__metadata__[0]
             if meta == types.Symbol.INPUT_PARAMETER:
                 parameters[f.name] = f.value
             elif meta == types.Symbol.INPUT_ARTIFACT or isinstance(meta, dflow.InputArtifact):
+                if f.optional and f.value is None:
+                    continue  # leave the optional artifact unbound
                 artifacts[f.name] = self._ensure_artifact(f.value)  # type: ignore
             elif meta == types.Symbol.OUTPUT_ARTIFACT or isinstance(meta, dflow.OutputArtifact):
-                template.outputs.artifacts[f.name].save = [self._ensure_artifact(f.value)]  # type: ignore
+                artifact = self._ensure_artifact(f.value)  # type: ignore
+                assert isinstance(artifact, dflow.S3Artifact), f'output artifact {f.name} should be a s3 url'
+                output_keys[f.name] = artifact.key
+                parameters[_save_key_param(f.name)] = artifact.key
             else:
                 raise ValueError(f'unsupported type {f.type}')
 
+        # the fingerprint of a step is chained with the fingerprints of the steps that produce its inputs,
+        # so that the change of upstream steps will invalidate the memoization of downstream steps
+        fingerprint = hashlib.sha256(repr({
+            'template': _template_fingerprint(template),
+            'parameters': sorted((k, self._parameter_digest(v)) for k, v in parameters.items()),
+            'artifacts': sorted((k, self._artifact_digest(v, memoize)) for k, v in artifacts.items()),
+            'with_param': self._parameter_digest(with_param),
+        }).encode()).hexdigest()
+        self._step_fingerprints[name] = fingerprint
+        for output_name, key in output_keys.items():
+            self._artifact_digests[key] = f'{fingerprint}/{output_name}'
+
+        if memoize:
+            memo_key = f'dg-{fingerprint[:32]}'
+            if with_param is not None:
+                memo_key += '-{{item}}'
+            parameters[_MEMO_KEY_PARAM] = memo_key
+
         step = dflow.Step(
             name=name,
             template=template,
@@ -697,11 +1043,98 @@ class DFlowBuilder:
         )
         return Step(step)
 
+    def _parameter_digest(self, value) -> str:
+        if isinstance(value, ArgoRange):
+            return repr([self._parameter_digest(v) for v in (value.start, value.end, value.step)])
+        if isinstance(value, ArgoLen):
+            return f'len({self._parameter_digest(value.param)})'
+        step = getattr(value, 'step', None)
+        if isinstance(step, dflow.Step) and step.name in self._step_fingerprints:
+            return f'{self._step_fingerprints[step.name]}/{value.name}'
+        return json.dumps(value, sort_keys=True, default=str)
+
+    def _artifact_digest(self, artifact, memoize: bool = False) -> str:
+        """
+        Get the digest of an input artifact.
+
+        For artifacts produced by previous steps, the digest is the fingerprint of the producer,
+        for artifacts uploaded with cache, the digest is computed from the content hash in the upload manifest.
+        """
+        if isinstance(artifact, dflow.S3Artifact):
+            key = artifact.key
+            # an artifact may be a part of the output of a step, or consist of the outputs of many steps
+            digests = sorted(digest for k, digest in self._artifact_digests.items() if _is_key_related(k, key))
+            if digests:
+                return hashlib.sha256(repr(digests).encode()).hexdigest()
+            if memoize:
+                entries = self._get_upload_manifest().entries
+                hashes = sorted((prefix, entry['hash']) for prefix, entry in entries.items()
+                                if any(_is_key_related(k, key) for k in (prefix, entry['key'])))
+                if hashes:
+                    return hashlib.sha256(repr(hashes).encode()).hexdigest()
+            return key
+        step = getattr(artifact, 'step', None)
+        if step is not None and step.name in self._step_fingerprints:
+            return f'{self._step_fingerprints[step.name]}/{artifact.name}'
+        return str(artifact)
+
+
+def _is_not_pyc_file(path: str):
+    return not (path.endswith('.pyc') or path.endswith('__pycache__'))
+
+
+def _is_excluded(path: str, excludes: Iterable[str]):
+    """
+    Check if a relative path is one of the excludes or is inside of them.
+    """
+    path = os.path.normpath(path)
+    return any(path == e or path.startswith(e.rstrip('/') + '/') for e in map(os.path.normpath, excludes))
 
-def _filter_pyc_files(tarinfo):
-    if tarinfo.name.endswith('.pyc') or tarinfo.name.endswith('__pycache__'):
-        return None
-    return tarinfo
+
+def _pkg_bundle_name(pkg: str):
+    # also used as artifact name, which only allows alphanumeric characters, '-' and '_'
+    return pkg.strip('/').replace('/', '-')
+
+
+def _is_key_related(a: str, b: str):
+    """
+    Check if one of the keys is the same as or the parent of another.
+    """
+    a, b = a.rstrip('/'), b.rstrip('/')
+    return a == b or a.startswith(b + '/') or b.startswith(a + '/')
+
+
+def _save_key_param(name: str):
+    return f'__save_{name}__'
+
+
+def _template_fingerprint(dflow_template: ScriptOPTemplate):
+    """
+    Compute the fingerprint of a template from its script and input/output signature.
+    """
+    def _key(artifact):
+        source = getattr(artifact, 'source', None)
+        return getattr(source, 'key', None)
+
+    signature = {
+        'command': dflow_template.command,
+        'memoize_key': dflow_template.memoize_key,
+        'script': dflow_template.script,
+        'input_parameters': sorted(dflow_template.inputs.parameters.keys()),
+        'input_artifacts': sorted(
+            (name, a.path, str(a.archive), bool(a.optional), _key(a))
+            for name, a in dflow_template.inputs.artifacts.items()
+        ),
+        'output_parameters': sorted(
+            (name, p.value_from_path)
+            for name, p in dflow_template.outputs.parameters.items()
+        ),
+        'output_artifacts': sorted(
+            (name, a.path, str(a.archive), bool(a.optional))
+            for name, a in dflow_template.outputs.artifacts.items()
+        ),
+    }
+    return hashlib.sha256(repr(signature).encode()).hexdigest()
 
 
 def _to_dflow_steps(steps: Steps):
@@ -710,6 +1143,36 @@ def _to_dflow_steps(steps: Steps):
     return [_to_dflow_steps(step) for step in steps]
 
 
+class _SharedRenderExecutor(Executor):
+    """
+    Share the rendered template among the steps of the same template and executor config.
+
+    Executors like DispatcherExecutor render a copy of template with a random name for each step,
+    which makes the shared templates duplicated again in the compiled workflow.
+    """
+
+    def __init__(self, executor: Executor, rendered_templates: Dict[str, Any]):
+        self.executor = executor
+        self.merge_sliced_step = getattr(executor, 'merge_sliced_step', False)
+        self._rendered_templates = rendered_templates
+        self._executor_key = json.dumps({'type': type(executor).__qualname__, **vars(executor)},
+                                        sort_keys=True, default=str)
+
+    def render(self, template):
+        key = hashlib.sha256(repr((template.name, self._executor_key)).encode()).hexdigest()
+        if key not in self._rendered_templates:
+            self._rendered_templates[key] = self.executor.render(template)
+        return self._rendered_templates[key]
+
+
+def _flatten(df_steps):
+    if isinstance(df_steps, list):
+        for df_step in df_steps:
+            yield from _flatten(df_step)
+    else:
+        yield df_steps
+
+
 def _dflow_script_check(source: Iterable[str], base_dir):
     """
     ensure the script is safe to run in dflow
@@ -0,0 +1,299 @@
+from dflow.io import Expression
+from dflow.step import ArgoRange, ArgoLen
+import dflow
+
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Optional, Dict, List, Any, Iterable
+from collections import namedtuple
+import subprocess
+import shutil
+import shlex
+import json
+import os
+
+from .log import get_logger
+from . import storage
+
+logger = get_logger(__name__)
+
+
+_Task = namedtuple('_Task', ['step_name', 'work_dir', 'command', 'script',
+                             'input_artifacts', 'output_artifacts', 'output_parameters',
+                             'memo_file', 'copy_method'])
+
+
+class LocalExecutor:
+    """
+    Run the steps of a DFlowBuilder in local machine.
+
+    Steps added with the same `add_steps` call are run in parallel,
+    and so are the items of a step with `with_param`,
+    all of them share the same process pool.
+    Different groups of steps are run sequentially in the order they are added.
+
+    Unlike the debug mode of dflow, the artifacts are always stored in the local storage,
+    and the inputs of a task are staged from the storage directly with `copy_method`.
+    """
+
+    def __init__(self, name: str,
+                 container_base_dir: str,
+                 memo_dir: str,
+                 max_workers: Optional[int] = None,
+                 copy_method: str = 'copy'):
+        """
+        :param name: The name of the workflow, which is used to create the working directory.
+        :param container_base_dir: The base directory of the resources in templates,
+            which will be mapped to the working directory of each task.
+        :param memo_dir: The directory to store the outputs of memoized tasks.
+        :param max_workers: The max number of tasks to run in parallel, default to the number of cpu cores.
+        :param copy_method: The method to stage input artifacts, one of 'copy', 'link' and 'symlink',
+            the same as `debug_copy_method` of dflow. Note that the stored artifacts of upstream steps
+            can be modified by a task that writes to its inputs unless it is 'copy'.
+        """
+        assert copy_method in ('copy', 'link', 'symlink'), f'unsupported copy method {copy_method}'
+        self.work_dir = os.path.abspath(os.path.join(dflow.config['debug_workdir'], name))
+        self.container_base_dir = container_base_dir
+        self.memo_dir = memo_dir
+        if max_workers is None or max_workers < 1:
+            max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+        self.copy_method = copy_method
+        # output parameters of steps, the value is a list if the step is run with `with_param`
+        self._outputs: Dict[str, Dict[str, Any]] = {}
+
+    def run(self, step_groups: Iterable[List[dflow.Step]]):
+        """
+        Run the groups of steps in order.
+
+        :return: True if all steps are succeeded, otherwise False.
+        """
+        logger.info(f'run workflow in {self.work_dir}')
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            for steps in step_groups:
+                futures: Dict[str, List[Future]] = {}
+                with_items: Dict[str, bool] = {}
+                for step in steps:
+                    items = self._resolve_items(step)
+                    with_items[step.name] = items is not None
+                    tasks = [self._make_task(step, i, item) for i, item in enumerate(items or [None])]
+                    logger.info(f'run step {step.name} with {len(tasks)} task(s)')
+                    futures[step.name] = [pool.submit(_run_task, task) for task in tasks]
+
+                failed = False
+                for step_name, step_futures in futures.items():
+                    outputs = []
+                    for future in step_futures:
+                        try:
+                            outputs.append(future.result())
+                        except Exception as e:
+                            logger.error(f'step {step_name} failed: {e}')
+                            failed = True
+                    if failed:
+                        continue
+                    if with_items[step_name]:
+                        self._outputs[step_name] = {k: [o[k] for o in outputs] for k in outputs[0]} if outputs else {}
+                    else:
+                        self._outputs[step_name] = outputs[0]
+                if failed:
+                    return False
+        return True
+
+    def _resolve_items(self, step: dflow.Step) -> Optional[list]:
+        with_param = step.with_param
+        if with_param is None:
+            return None
+        if isinstance(with_param, Expression):
+            items = eval(with_param.expr)
+        elif isinstance(with_param, ArgoRange):
+            items = range(self._resolve_int(with_param.start), self._resolve_int(with_param.end),
+                          self._resolve_int(with_param.step))
+        elif _is_output_parameter(with_param):
+            items = self._get_output(with_param)
+        elif isinstance(with_param, str):
+            items = json.loads(with_param)
+        elif isinstance(with_param, (list, tuple, range)):
+            items = with_param
+        else:
+            raise ValueError(f'unsupported with_param {with_param} of step {step.name}')
+        if isinstance(items, str):
+            items = json.loads(items)
+        return list(items)
+
+    def _resolve_int(self, value) -> int:
+        """
+        Resolve the bound of argo_range, which can be a number, an output parameter or the length of it.
+        """
+        if isinstance(value, ArgoLen):
+            items = self._get_output(value.param) if _is_output_parameter(value.param) else value.param
+            return len(json.loads(items) if isinstance(items, str) else items)
+        if _is_output_parameter(value):
+            value = self._get_output(value)
+        return int(value)
+
+    def _get_output(self, param) -> Any:
+        step_name = param.step.name
+        if step_name not in self._outputs:
+            raise ValueError(f'step {step_name} should be run before its output {param.name} is used')
+        return self._outputs[step_name][param.name]
+
+    def _make_task(self, step: dflow.Step, index: int, item: Any):
+        template = step.template
+        work_dir = os.path.join(self.work_dir, step.name, str(index))
+
+        item_str = item if isinstance(item, str) else json.dumps(item)
+        parameters = {}
+        for name, param in step.inputs.parameters.items():
+            value = param.value
+            if _is_output_parameter(value):
+                value = self._get_output(value)
+            if not isinstance(value, str):
+                value = json.dumps(value)
+            if item is not None:
+                value = value.replace('{{item}}', item_str)
+            parameters[name] = value
+
+        script = _render(template.script, parameters)
+        script = script.replace(self.container_base_dir, self._localize(work_dir, self.container_base_dir))
+
+        input_artifacts = []
+        for name, artifact in template.inputs.artifacts.items():
+            source = artifact.source
+            if name in step.inputs.artifacts and step.inputs.artifacts[name].source is not None:
+                source = step.inputs.artifacts[name].source
+            if source is None:
+                assert artifact.optional, f'input artifact {name} of step {step.name} is not provided'
+                continue
+            key = self._get_artifact_key(source)
+            if item is not None:
+                key = key.replace('{{item}}', item_str)
+            input_artifacts.append((key, self._localize(work_dir, artifact.path), bool(artifact.optional)))
+
+        output_artifacts = []
+        for name, artifact in template.outputs.artifacts.items():
+            key = _get_save_key(artifact, parameters)
+            output_artifacts.append((self._localize(work_dir, artifact.path), key, bool(artifact.optional)))
+
+        output_parameters = {
+            name: self._localize(work_dir, param.value_from_path)
+            for name, param in template.outputs.parameters.items()
+        }
+
+        memo_file = None
+        if template.memoize_key:
+            memo_file = os.path.join(self.memo_dir, _render(template.memoize_key, parameters) + '.json')
+
+        command = template.command
+        if isinstance(command, str):
+            command = shlex.split(command)
+        return _Task(step_name=step.name, work_dir=work_dir, command=command, script=script,
+                     input_artifacts=input_artifacts, output_artifacts=output_artifacts,
+                     output_parameters=output_parameters, memo_file=memo_file, copy_method=self.copy_method)
+
+    def _get_artifact_key(self, source) -> str:
+        if isinstance(source, dflow.S3Artifact):
+            return storage.resolve_key(source.key)
+        step = getattr(source, 'step', None)
+        if step is not None:
+            parameters = {name: param.value for name, param in step.inputs.parameters.items()}
+            return _get_save_key(step.template.outputs.artifacts[source.name], parameters)
+        raise ValueError(f'unsupported artifact source {source}')
+
+    def _localize(self, work_dir: str, path: str):
+        """
+        Map the path in container to the working directory of the task.
+        """
+        return os.path.join(work_dir, 'rootfs', path.lstrip('/'))
+
+
+def _render(text: str, parameters: Dict[str, Any]):
+    for name, value in parameters.items():
+        text = text.replace(f'{{{{inputs.parameters.{name}}}}}', str(value))
+    return text
+
+
+def _get_save_key(artifact: dflow.OutputArtifact, parameters: Dict[str, Any]):
+    """
+    Get the key to save the output artifact, which may be rendered from the input parameters.
+    """
+    assert artifact.save, f'output artifact {artifact} should be saved to s3'
+    return storage.resolve_key(_render(artifact.save[0].key, parameters))
+
+
+def _is_output_parameter(value):
+    return isinstance(value, dflow.OutputParameter) and getattr(value, 'step', None) is not None
+
+
+def _stage_input(key: str, path: str, copy_method: str):
+    if copy_method == 'symlink':
+        os.symlink(key, path)
+        return
+    copy_fn = _try_link if copy_method == 'link' else shutil.copy2
+    if os.path.isdir(key):
+        shutil.copytree(key, path, symlinks=True, copy_function=copy_fn)
+    else:
+        copy_fn(key, path)
+
+
+def _try_link(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _run_task(task: _Task) -> Dict[str, Optional[str]]:
+    """
+    Run a task in a subprocess and return its output parameters.
+    """
+    if task.memo_file is not None and os.path.exists(task.memo_file):
+        logger.info(f'task {task.work_dir} has been memoized in {task.memo_file}, skip')
+        with open(task.memo_file, 'r') as fp:
+            return json.load(fp)
+
+    shutil.rmtree(task.work_dir, ignore_errors=True)
+    os.makedirs(task.work_dir)
+    for key, path, optional in task.input_artifacts:
+        if not os.path.exists(key):
+            if optional:
+                continue
+            raise FileNotFoundError(f'input artifact {key} of step {task.step_name} not found')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _stage_input(key, path, task.copy_method)
+
+    script_file = os.path.join(task.work_dir, 'script')
+    log_file = os.path.join(task.work_dir, 'log.txt')
+    with open(script_file, 'w') as fp:
+        fp.write(task.script)
+    with open(log_file, 'w') as fp:
+        env = {**os.environ, 'ARGO_PROGRESS_FILE': os.path.join(task.work_dir, 'argo_progress_file.txt')}
+        ret = subprocess.run([*task.command, script_file], cwd=task.work_dir, env=env,
+                             stdout=fp, stderr=subprocess.STDOUT)
+    if ret.returncode != 0:
+        with open(log_file, 'r') as fp:
+            tail = ''.join(fp.readlines()[-20:])
+        raise RuntimeError(f'task {task.work_dir} failed with exit code {ret.returncode}, '
+                           f'see {log_file} for details:\n{tail}')
+
+    for path, key, optional in task.output_artifacts:
+        if not os.path.exists(path):
+            if optional:
+                continue
+            raise FileNotFoundError(f'output artifact {path} of step {task.step_name} not found')
+        if os.path.isdir(path):
+            shutil.copytree(path, key, dirs_exist_ok=True, ignore_dangling_symlinks=True)
+        else:
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            shutil.copy2(path, key)
+
+    outputs = {}
+    for name, path in task.output_parameters.items():
+        outputs[name] = None
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                outputs[name] = fp.read()
+
+    if task.memo_file is not None:
+        os.makedirs(os.path.dirname(task.memo_file), exist_ok=True)
+        with open(task.memo_file, 'w') as fp:
+            json.dump(outputs, fp)
+    return outputs
@@ -0,0 +1,188 @@
+from dflow.utils import StorageClient, MinioClient
+import dflow
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple, Dict, Optional
+import hashlib
+import shutil
+import json
+import os
+
+
+MB = 1 << 20
+
+
+def is_local_mode():
+    """
+    In dflow debug mode (without debug_s3), artifacts are stored in the local file system.
+    """
+    return dflow.config['mode'] == 'debug' and not dflow.config['debug_s3']
+
+
+def get_storage_client() -> StorageClient:
+    client = dflow.s3_config['storage_client']
+    if client is None:
+        client = MinioClient()
+    return client
+
+
+def resolve_key(key: str) -> str:
+    """
+    Resolve the key to the form returned by `dflow.upload_s3`.
+    """
+    if is_local_mode():
+        return os.path.abspath(os.path.join(
+            dflow.config['debug_workdir'], dflow.config['debug_artifact_dir'], key))
+    prefixes = [dflow.s3_config['prefix'], *dflow.s3_config['extra_prefixes']]
+    if any(key.startswith(p) for p in prefixes if p):
+        return key
+    return dflow.s3_config['prefix'] + key
+
+
+def exists(key: str) -> bool:
+    """
+    Check if an object or a directory exists in storage.
+
+    :param key: The resolved key of the object.
+    """
+    if is_local_mode():
+        return os.path.exists(key)
+    return any(k == key or k.startswith(key.rstrip('/') + '/')
+               for k in get_storage_client().list(prefix=key))
+
+
+def download_file(key: str, path: str):
+    """
+    Download a single object from storage.
+
+    :param key: The resolved key of the object.
+    :param path: The local path to save the object.
+    """
+    if is_local_mode():
+        shutil.copy2(key, path)
+    else:
+        get_storage_client().download(key=key, path=path)
+
+
+def upload_files(items: Iterable[Tuple[str, str]],
+                 max_workers: int = 8,
+                 multipart_threshold: int = 64 * MB,
+                 part_size: int = 16 * MB) -> List[str]:
+    """
+    Upload files or directories to storage concurrently.
+
+    Directories are expanded to files so that small files can be uploaded in parallel,
+    and large files are uploaded with multipart if the storage client supports it.
+
+    :param items: (path, key) pairs to upload, the key should be resolved.
+    :param max_workers: The max number of concurrent uploads.
+    :param multipart_threshold: Files larger than this size will be uploaded with multipart.
+    :param part_size: The size of each part in multipart upload.
+    :return: The keys of the uploaded items, in the same order as the input.
+    """
+    client = get_storage_client()
+    keys = []
+    tasks = []
+    for path, key in items:
+        path = str(path)
+        if os.path.isfile(path):
+            tasks.append((path, key))
+        elif os.path.isdir(path):
+            for root, _dirs, files in os.walk(path, followlinks=True):
+                rel_root = os.path.relpath(root, path)
+                for file in files:
+                    rel_path = os.path.normpath(os.path.join(rel_root, file))
+                    tasks.append((os.path.join(root, file), f'{key}/{rel_path}'))
+        else:
+            raise FileNotFoundError(f'No such file or directory: {path}')
+        keys.append(key)
+
+    def _upload(task):
+        path, key = task
+        if isinstance(client, MinioClient) and os.path.getsize(path) >= multipart_threshold:
+            client.client.fput_object(bucket_name=client.bucket_name, object_name=key,
+                                      file_path=path, part_size=part_size)
+        else:
+            client.upload(key=key, path=path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the iterator to raise the first error if any
+        list(executor.map(_upload, tasks))
+    return keys
+
+
+class UploadManifest:
+    """
+    A manifest to record the content hash of uploaded paths,
+    so that unchanged content won't be uploaded again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+
+    def load(self, path: Optional[str] = None):
+        """
+        Load entries from file, entries in the file will override the existed ones.
+        """
+        path = path or self.path
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                self.entries.update(json.load(fp))
+
+    def dump(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.entries, fp, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get(self, prefix: str, content_hash: str) -> Optional[str]:
+        """
+        Get the key of uploaded content, return None if the content has changed.
+        """
+        entry = self.entries.get(prefix)
+        if entry is not None and entry['hash'] == content_hash:
+            return entry['key']
+        return None
+
+    def set(self, prefix: str, content_hash: str, key: str):
+        self.entries[prefix] = {'hash': content_hash, 'key': key}
+
+
+class LocalStorageClient(StorageClient):
+    """
+    A storage client that stores objects in the local file system,
+    which can be used as a stand-in of S3 for testing.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str):
+        return os.path.join(self.root, key)
+
+    def upload(self, key: str, path: str) -> None:
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(path, target)
+
+    def download(self, key: str, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        shutil.copy2(self._path(key), path)
+
+    def list(self, prefix: str, recursive: bool = False) -> List[str]:
+        keys = []
+        for root, _dirs, files in os.walk(self.root):
+            for file in files:
+                key = os.path.relpath(os.path.join(root, file), self.root)
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def copy(self, src: str, dst: str) -> None:
+        self.upload(dst, self._path(src))
+
+    def get_md5(self, key: str) -> str:
+        with open(self._path(key), 'rb') as fp:
+            return hashlib.md5(fp.read()).hexdigest()
@@ -1,5 +1,6 @@
-from typing import Optional, TypeVar
+from typing import Optional, TypeVar, Callable, Sequence, List
 from ai2_kit.core.util import list_split
+import hashlib
 import sys
 import os
 
@@ -60,7 +61,7 @@ def bash_inspect_dir(dir: str):
 
 
 def bash_iter_ls_slice(search_pattern: str, /, n: int, i: SliceIndex, script: ListStr, opt: str = '',
-                       it_var='ITEM', python_cmd: str = 'python'):
+                       it_var='ITEM', python_cmd: str = 'python', workers: int = 1):
     """
     Generate a bash snippet to slice the result of `ls` command,
     and iterate over the selected chunk.
@@ -70,22 +71,47 @@ def bash_iter_ls_slice(search_pattern: str, /, n: int, i: SliceIndex, script: Li
     :param i: chunk index
     :param script: bash script to process each directory
     :param it_var: variable name for each item
+    :param workers: max number of items to process in parallel, see `bash_iter_var`
     """
     return '\n'.join([
         f'_LS_RESULT=$(ls -1 {opt} {search_pattern} | sort)',
         bash_slice(in_var='_LS_RESULT', n=n, i=i, out_var='_LS_CHUNK', python_cmd=python_cmd),
-        bash_iter_var(in_var='_LS_CHUNK', script=script, it_var=it_var),
+        bash_iter_var(in_var='_LS_CHUNK', script=script, it_var=it_var, workers=workers),
     ])
 
 
-def bash_iter_var(in_var: str, script: ListStr, it_var='ITEM', report_progress=True):
+def bash_iter_ls(search_pattern: str, /, script: ListStr, opt: str = '', it_var='ITEM', workers: int = 1):
+    """
+    Generate a bash snippet to iterate over the result of `ls` command.
+
+    :param search_pattern: search pattern for directories
+    :param script: bash script to process each directory
+    :param it_var: variable name for each item
+    :param workers: max number of items to process in parallel, see `bash_iter_var`
+    """
+    return '\n'.join([
+        f'_LS_RESULT=$(ls -1 {opt} {search_pattern} | sort)',
+        bash_iter_var(in_var='_LS_RESULT', script=script, it_var=it_var, workers=workers),
+    ])
+
+
+def bash_iter_var(in_var: str, script: ListStr, it_var='ITEM', report_progress=True, workers: int = 1):
     """
     Generate a bash snippet to iterate over lines of a variable
 
+    If workers is greater than 1, each item is processed in a background subshell,
+    and at most `workers` items run at the same time.
+    The loop will wait for all running items and exit with error if any of them failed.
+    The part of script that should not run concurrently, e.g. moving result to persist dir,
+    should be wrapped with `bash_iter_lock`, which requires `flock` command in parallel mode.
+
     :param in_var: variable name of input data
     :param script: bash script to process each line
+    :param workers: max number of items to process in parallel
     """
     script = ensure_str(script)
+    if workers > 1:
+        return _bash_iter_var_parallel(in_var, script, it_var, report_progress, workers)
 
     argo_progress_init, argo_progress_count  = '', ''
     if report_progress:
@@ -93,6 +119,7 @@ def bash_iter_var(in_var: str, script: ListStr, it_var='ITEM', report_progress=T
         argo_progress_count = '_ARGO_I=$((_ARGO_I + 1)) && echo "$_ARGO_I/$_N_LINES" > $ARGO_PROGRESS_FILE'
 
     return f"""_N_LINES=$(grep . <<< "${in_var}" | wc -l)
+_ITER_LOCK=
 {argo_progress_init}
 if [ $_N_LINES -ne 0 ]; then
 while IFS= read -r {it_var}; do
@@ -102,6 +129,50 @@ done <<< "${in_var}"
 fi"""
 
 
+def _bash_iter_var_parallel(in_var: str, script: str, it_var: str, report_progress: bool, workers: int):
+    argo_progress_init, argo_progress_count  = '', ''
+    if report_progress:
+        argo_progress_init = f'echo "0/$_N_LINES" > $ARGO_PROGRESS_FILE'
+        argo_progress_count = bash_iter_lock([
+            f'echo "${it_var}" >> "$_ITER_DONE"',
+            'echo "$(grep -c . "$_ITER_DONE")/$_N_LINES" > $ARGO_PROGRESS_FILE',
+        ])
+
+    return f"""_N_LINES=$(grep . <<< "${in_var}" | wc -l)
+_ITER_LOCK=$(mktemp) && _ITER_DONE=$(mktemp) && _ITER_FAILED=$(mktemp)
+trap 'rm -f "$_ITER_LOCK" "$_ITER_DONE" "$_ITER_FAILED"' EXIT
+{argo_progress_init}
+if [ $_N_LINES -ne 0 ]; then
+while IFS= read -r {it_var}; do
+while [ "$(jobs -rp | wc -l)" -ge {workers} ]; do wait -n || true; done
+(
+trap '[ $? -eq 0 ] || echo "${it_var}" >> "$_ITER_FAILED"' EXIT
+{script}
+{argo_progress_count}
+) &
+done <<< "${in_var}"
+wait
+fi
+_ITER_FAILED_ITEMS=$(cat "$_ITER_FAILED")
+rm -f "$_ITER_LOCK" "$_ITER_DONE" "$_ITER_FAILED" && trap - EXIT && unset _ITER_LOCK
+if [ -n "$_ITER_FAILED_ITEMS" ]; then
+echo "failed items:" && echo "$_ITER_FAILED_ITEMS" && exit 1
+fi"""
+
+
+def bash_iter_lock(script: ListStr):
+    """
+    Generate a bash snippet to run the script exclusively among the items of `bash_iter_var`.
+    It is a no-op if the items are processed sequentially.
+
+    :param script: bash script to run with lock
+    """
+    script = ensure_str(script)
+    return f"""(
+if [ -n "$_ITER_LOCK" ]; then exec 9> "$_ITER_LOCK" && flock 9; fi
+{script}
+)"""
+
 
 def bash_slice(in_var: str, n: int, i: SliceIndex, out_var: str,
                python_cmd: str = 'python'):
@@ -115,8 +186,8 @@ def bash_slice(in_var: str, n: int, i: SliceIndex, out_var: str,
     :param out_var: variable name to store the selected chunk
     """
     return f"""# bash_slice({in_var}, {n}, {i}, {out_var})
-which python3 && PY_CMD=python3 || PY_CMD=python  # prefer python3
-which "{python_cmd}" && PY_CMD="{python_cmd}" || true  # prefer user specified python
+which python3 > /dev/null 2>&1 && PY_CMD=python3 || PY_CMD=python  # prefer python3
+which "{python_cmd}" > /dev/null 2>&1 && PY_CMD="{python_cmd}" || true  # prefer user specified python
 {out_var}=$(_IN_DATA="${in_var}" _SLICE_N={n} _SLICE_I={i} $PY_CMD << EOF
 import sys,os
 lines = os.environ['_IN_DATA'].split('\\n')
@@ -133,6 +204,27 @@ EOF
 # bash_slice end"""
 
 
+def lpt_partition(costs: Sequence[float], n: int) -> List[List[int]]:
+    """
+    Partition items into n chunks with the longest-processing-time-first rule,
+    so that the max total cost of chunks is close to the optimal.
+
+    The result is deterministic: items with the same cost are assigned in the order of their indices,
+    and ties of chunk load are broken by the index of chunk.
+
+    :param costs: cost of each item
+    :param n: number of chunks
+    :return: indices of items in each chunk, in ascending order
+    """
+    chunks = [[] for _ in range(n)]
+    loads = [0.0] * n
+    for k in sorted(range(len(costs)), key=lambda k: (-costs[k], k)):
+        j = min(range(n), key=lambda j: (loads[j], j))
+        chunks[j].append(k)
+        loads[j] += costs[k]
+    return [sorted(chunk) for chunk in chunks]
+
+
 def yes_or_no(msg: str, default: bool = False):
     """
     prompt user for input, if user press n or N, return False
@@ -179,6 +271,39 @@ def resolve_ln(path: str, mv=False):
                 resolve_ln(dir_path, mv=mv)
 
 
+def hash_path(path: str, include: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    Compute the sha256 digest of a file or a directory tree.
+    For directory, both the relative paths and the content of files are taken into account.
+
+    :param path: the file or directory to hash
+    :param include: a function that accepts a relative path and returns False to skip it
+    """
+    h = hashlib.sha256()
+    if os.path.isfile(path):
+        _hash_file(h, path)
+        return h.hexdigest()
+
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs.sort()
+        rel_root = os.path.relpath(root, path)
+        if include is not None:
+            dirs[:] = [d for d in dirs if include(os.path.normpath(os.path.join(rel_root, d)))]
+        for file in sorted(files):
+            rel_path = os.path.normpath(os.path.join(rel_root, file))
+            if include is not None and not include(rel_path):
+                continue
+            h.update(rel_path.encode() + b'\0')
+            _hash_file(h, os.path.join(root, file))
+    return h.hexdigest()
+
+
+def _hash_file(h, path: str, chunk_size: int = 1 << 20):
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            h.update(chunk)
+
+
 def parse_string_array(s: str, dtype=None, delimiter=None):
     arr = [x.strip() for x in s.split(delimiter)]
     if dtype:
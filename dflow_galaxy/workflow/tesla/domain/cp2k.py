@@ -1,4 +1,4 @@
-from typing import List, Optional, Mapping, Any, Literal
+from typing import List, Optional, Mapping, Any, Literal, TYPE_CHECKING
 from dataclasses import dataclass
 from copy import deepcopy
 from pathlib import Path
@@ -7,17 +7,17 @@ import os
 
 from dflow_galaxy.core.pydantic import BaseModel
 from dflow_galaxy.core.dispatcher import BaseApp, PythonApp, create_dispatcher, ExecutorConfig
-from dflow_galaxy.core.dflow_builder import DFlowBuilder
-from dflow_galaxy.core.util import bash_iter_ls_slice, safe_ln, bash_ln_cmd, bash_inspect_dir, inspect_dir
+from dflow_galaxy.core.util import bash_iter_ls, bash_iter_lock, safe_ln, bash_ln_cmd, bash_inspect_dir, inspect_dir
 from dflow_galaxy.core import types
 
-from ai2_kit.domain.cp2k import make_cp2k_task_dirs
 from ai2_kit.core.artifact import Artifact, ArtifactDict
 from ai2_kit.core.util import cmd_with_checkpoint as cmd_cp, list_sample, load_text, dump_text, ensure_dir
 
-from dflow import argo_range
+from .lib import resolve_artifact, split_task_dirs, dump_task_cost, SetupTasksResult
+from .lib import bash_persist_task, bash_restore_task
 
-from .lib import resolve_artifact
+if TYPE_CHECKING:
+    from dflow_galaxy.core.dflow_builder import DFlowBuilder
 
 SYSTEM_DIR = './system_dir'
 
@@ -25,6 +25,19 @@ SYSTEM_DIR = './system_dir'
 class Cp2kApp(BaseApp):
     cp2k_cmd: str = 'cp2k.popt'
     concurrency: int = 5
+    """
+    Max number of slices to run tasks in parallel, one slice per task if it is not positive.
+    """
+    tasks_per_pod: int = 1
+    """
+    Max number of tasks to run in parallel in the same pod,
+    the resource requested by each task should be taken into account when setting the command.
+    """
+    pack_outputs: bool = False
+    """
+    Pack the outputs of each task into a single tar.gz before persisting,
+    which reduces the number of objects to upload and download.
+    """
 
 
 class Cp2kConfig(BaseModel):
@@ -44,12 +57,15 @@ class SetupCp2kTasksArgs:
 
 class SetupCp2kTaskFn:
 
-    def __init__(self, config: Cp2kConfig, systems: Mapping[str, Artifact], init: bool):
+    def __init__(self, config: Cp2kConfig, systems: Mapping[str, Artifact], init: bool, concurrency: int):
         self.config = config
         self.init = init
         self.systems = systems
+        self.concurrency = concurrency
+
+    def __call__(self, args: SetupCp2kTasksArgs) -> SetupTasksResult:
+        from ai2_kit.domain.cp2k import make_cp2k_task_dirs
 
-    def __call__(self, args: SetupCp2kTasksArgs):
         safe_ln(args.system_dir, SYSTEM_DIR)
         inspect_dir(SYSTEM_DIR)
 
@@ -97,11 +113,32 @@ class SetupCp2kTaskFn:
         for task_dir in task_dirs:
             path = os.path.join(task_dir['url'], 'ANCESTOR')
             dump_text(task_dir['attrs']['ancestor'], path)
+            # the cost of DFT calculation scales as O(N^3)
+            n_atoms = _count_cp2k_atoms(os.path.join(task_dir['url'], 'coord_n_cell.inc'))
+            dump_task_cost(task_dir['url'], n_atoms ** 3)
+        slices = split_task_dirs(args.work_dir, self.concurrency)
+        return SetupTasksResult(slices=slices)
+
+
+def _count_cp2k_atoms(coord_file: str) -> int:
+    """
+    Count the atoms in the &COORD section of cp2k input.
+    """
+    n, in_coord = 0, False
+    with open(coord_file) as fp:
+        for line in fp:
+            line = line.strip().upper()
+            if line.startswith('&COORD'):
+                in_coord = True
+            elif line.startswith('&END'):
+                in_coord = False
+            elif in_coord and line:
+                n += 1
+    return n
 
 
 @dataclass(frozen=True)
 class RunCp2kTasksArgs:
-    slice_idx: types.InputParam[types.SliceIndex]
     work_dir: types.InputArtifact
     persist_dir: types.OutputArtifact
 
@@ -112,24 +149,24 @@ class RunCp2kTasksFn:
         self.context = context
 
     def __call__(self, args: RunCp2kTasksArgs):
-        c = self.context.concurrency
-
         script = [
             f'mkdir -p {args.persist_dir} && touch {args.persist_dir}/.placeholder',
             f"pushd {args.work_dir}",
             bash_inspect_dir('.'),
-            bash_iter_ls_slice(
-                'tasks/*/', opt='-d', n=c, i=args.slice_idx, it_var='ITEM',
+            bash_iter_ls(
+                'tasks/*/', opt='-d', it_var='ITEM', workers=self.context.tasks_per_pod,
                 script=[
                     'pushd $ITEM',
-                    'mv persist/* . || true  # recover checkpoint',
+                    bash_restore_task(),
                     '',
                     self._build_cp2k_script(),
                     '',
                     '# persist result',
-                    f'PERSIST_DIR={args.persist_dir}/$ITEM/persist/',
-                    'mkdir -p $PERSIST_DIR',
-                    'mv *.done output ANCESTOR $PERSIST_DIR',
+                    bash_iter_lock([
+                        f'PERSIST_DIR={args.persist_dir}/$ITEM/persist/',
+                        'mkdir -p $PERSIST_DIR',
+                        bash_persist_task('*.done output ANCESTOR', '$PERSIST_DIR', pack=self.context.pack_outputs),
+                    ]),
                     'popd',
                 ]
             ),
@@ -142,7 +179,7 @@ class RunCp2kTasksFn:
         return cmd_cp(cmd, 'cp2k.done')
 
 
-def provision_cp2k(builder: DFlowBuilder, ns: str, /,
+def provision_cp2k(builder: 'DFlowBuilder', ns: str, /,
                    config: Cp2kConfig,
                    executor: ExecutorConfig,
                    cp2k_app: Cp2kApp,
@@ -154,7 +191,7 @@ def provision_cp2k(builder: DFlowBuilder, ns: str, /,
                    init: bool,
                    systems: Mapping[str, Artifact],
                    ):
-    setup_tasks_fn = SetupCp2kTaskFn(config, systems=systems, init=init)
+    setup_tasks_fn = SetupCp2kTaskFn(config, systems=systems, init=init, concurrency=cp2k_app.concurrency)
     setup_tasks_step = builder.make_python_step(setup_tasks_fn, uid=f'{ns}-setup-task',
                                                 setup_script=python_app.setup_script,
                                                 executor=create_dispatcher(executor, python_app.resource))(
@@ -167,12 +204,12 @@ def provision_cp2k(builder: DFlowBuilder, ns: str, /,
     run_tasks_fn = RunCp2kTasksFn(config, cp2k_app)
     run_tasks_step = builder.make_bash_step(run_tasks_fn, uid=f'{ns}-run-task',
                                             setup_script=cp2k_app.setup_script,
-                                            with_param=argo_range(cp2k_app.concurrency),
+                                            with_param=setup_tasks_step.result.slices,
                                             executor=create_dispatcher(executor, cp2k_app.resource))(
         RunCp2kTasksArgs(
-            slice_idx='{{item}}',
-            work_dir=work_dir_url,
-            persist_dir=work_dir_url,
+            # each item only download and persist its own slice
+            work_dir=f'{work_dir_url}/slices/{{{{item}}}}',
+            persist_dir=f'{work_dir_url}/slices/{{{{item}}}}',
         )
     )
 
@@ -1,33 +1,62 @@
 from dataclasses import dataclass
-from typing import List, Tuple, Optional
-from itertools import groupby
+from typing import List, Optional, TYPE_CHECKING
 from pathlib import Path
+import traceback
+import copy
+import tempfile
+import shutil
 import glob
+import os
 
-from ai2_kit.domain.deepmd import make_deepmd_task_dirs
-from ai2_kit.core.util import cmd_with_checkpoint as cmd_cp, load_text
+from ai2_kit.core.util import cmd_with_checkpoint as cmd_cp, load_text, dump_text
 from ai2_kit.domain.constant import DP_INPUT_FILE, DP_ORIGINAL_MODEL, DP_FROZEN_MODEL
 
 from dflow_galaxy.core.pydantic import BaseModel
 from dflow_galaxy.core.dispatcher import BaseApp, PythonApp, create_dispatcher, ExecutorConfig
-from dflow_galaxy.core.dflow_builder import DFlowBuilder
-from dflow_galaxy.core.util import bash_iter_ls_slice, safe_ln, bash_ln_cmd, bash_inspect_dir, inspect_dir
+from dflow_galaxy.core.util import bash_iter_ls, safe_ln, bash_ln_cmd, bash_inspect_dir, inspect_dir, hash_path
 from dflow_galaxy.core.log import get_logger
 from dflow_galaxy.core import types
 
-from dflow import argo_range
-import dpdata
+import numpy as np
 
-from .lib import LabelApp
+from .lib import LabelApp, glob_task_dirs, split_task_dirs, unpack_persist_dir, SetupTasksResult
+
+if TYPE_CHECKING:
+    from dflow_galaxy.core.dflow_builder import DFlowBuilder
+    import dpdata
 
 logger = get_logger(__name__)
 
 INIT_DATASET_DIR = './init-dataset'
 ITER_DATASET_DIR = './iter-dataset'
+PARSED_CACHE = 'output.npz'
+DATASET_MANIFEST = 'MANIFEST'
+DATASET_INDEX = 'dataset/iter-dataset.lst'
+DP_MODELS_DIR = 'models'
 
 class DeepmdApp(BaseApp):
     dp_cmd: str = 'dp'
     concurrency: int = 4
+    """
+    Max number of slices to run tasks in parallel, one slice per task if it is not positive.
+    """
+    checkpoint_interval: int = 0
+    """
+    Interval in minutes to sync the checkpoints of training to the persist dir in background,
+    so that the retry of an interrupted training can restart from them. Disabled if it is not positive.
+    Only supported by hpc executor with `clean` disabled, whose remote work dir outlives an interrupted job
+    and is reused by the retry, as the persist dir is only uploaded when the step is done.
+    The checkpoints are removed once the training is done, only the models are persisted.
+    """
+    dataset_cache_dir: Optional[str] = None
+    """
+    Dir to cache the iter datasets across iterations, only supported by hpc executor,
+    a relative path is resolved against the base_dir of the executor.
+    If it is set, training tasks only download the dataset of the current iteration
+    and read the datasets of previous iterations from the cache.
+    Datasets missing in the cache, e.g. the option is enabled in the middle or the cache is cleaned,
+    are filled by the setup step from the full datasets it downloads.
+    """
 
 
 class DeepmdConfig(BaseModel):
@@ -36,55 +65,194 @@ class DeepmdConfig(BaseModel):
     input_template: dict = {}
     compress_model: bool = False
     ignore_error: bool = False
+    warm_start: bool = False
+    """
+    Initialize each model from the model of the same index in the previous iteration,
+    the first iteration is always trained from scratch.
+    The training tasks are sliced in the same way across iterations so that each slice only downloads
+    the models of its own tasks, so `model_num` and the concurrency of deepmd should not be changed.
+    """
+    warm_start_numb_steps: Optional[int] = None
+    """
+    `training.numb_steps` to use when the models are warm started, use the value of input_template if not set.
+    """
 
 
 @dataclass(frozen=True)
 class UpdateDatasetArgs:
     label_dir: types.InputArtifact
     iter_dataset_dir: types.OutputArtifact
+    parsed_dir: types.OutputArtifact
+    """
+    Dir to persist the parsed label outputs, the layout is the same as label_dir.
+    """
+    prev_parsed_dir: Optional[types.InputArtifact] = None
+    """
+    The parsed_dir persisted by the previous run of the step, so that the parsed outputs are reused by rerun.
+    """
 
 
 class UpdateDatasetFn:
-    def __init__(self, config: DeepmdConfig, iter_str: str, label_app: Optional[LabelApp], type_map: List[str]):
+    def __init__(self, config: DeepmdConfig, iter_str: str, label_app: Optional[LabelApp], type_map: List[str],
+                 workers: int = 1):
+        """
+        :param workers: number of processes to parse the label outputs
+        """
         self.config = config
         self.iter_str = iter_str
         self.label_app = label_app
         self.type_map = type_map
+        self.workers = workers
 
     def __call__(self, args: UpdateDatasetArgs):
-        dp_sys_list:List[Tuple[str, dpdata.LabeledSystem]] = []
+        dataset_dir = Path(args.iter_dataset_dir) / self.iter_str
+        dataset_dir.mkdir(parents=True, exist_ok=True)
 
-        # parse label data
+        # parse label data, and write them to the dataset of their ancestor one by one,
+        # so that only the data of a single task is kept in memory
+        os.makedirs(args.parsed_dir, exist_ok=True)
+        if args.prev_parsed_dir and os.path.isdir(args.prev_parsed_dir):
+            shutil.copytree(args.prev_parsed_dir, args.parsed_dir, dirs_exist_ok=True)
         if self.label_app == 'cp2k':
-            cp2k_dirs = glob.glob(f'{args.label_dir}/tasks/*/persist')
-            for cp2k_dir in cp2k_dirs:
-                try:
-                    ancestor = load_text(f'{cp2k_dir}/ANCESTOR')
-                    dp_sys = dpdata.LabeledSystem(f'{cp2k_dir}/output', fmt='cp2k/output', type_map=self.type_map)
-                    if dp_sys is not None and len(dp_sys) > 0:
-                        dp_sys_list.append((ancestor,dp_sys))
-                    else:
-                        logger.warn(f'Ignore empty dp system: {cp2k_dir}')
-                except Exception as e:
-                    logger.exception(f'Failed to load cp2k output: {cp2k_dir}')
+            from joblib import Parallel, delayed
+            cp2k_dirs = glob_task_dirs(args.label_dir, 'persist')
+            results = Parallel(n_jobs=self.workers, return_as='generator')(
+                delayed(self._parse_cp2k_dir)(cp2k_dir, args.label_dir, args.parsed_dir) for cp2k_dir in cp2k_dirs
+            )
+            for cp2k_dir, (ancestor, dp_sys, error) in zip(cp2k_dirs, results):  # type: ignore
+                if error is not None:
+                    logger.error(f'Failed to load cp2k output: {cp2k_dir}\n{error}')
                     if not self.config.ignore_error:
-                        raise e
+                        raise RuntimeError(f'Failed to load cp2k output: {cp2k_dir}')
+                elif dp_sys is not None and len(dp_sys) > 0:
+                    assert ancestor, 'ancestor should not be empty'
+                    append_deepmd_npy(dp_sys, dataset_dir / ancestor, type_map=self.type_map)
+                else:
+                    logger.warn(f'Ignore empty dp system: {cp2k_dir}')
         else:
             raise ValueError(f'Unsupported label app: {self.label_app}')
-
-        # dump data
-        dataset_dir = Path(args.iter_dataset_dir) / self.iter_str
-        dataset_dir.mkdir(parents=True, exist_ok=True)
-
-        # group dataset by ancestor
-        dp_sys_list = sorted(dp_sys_list, key=lambda x: x[0])  # sorted by ancestor
-        for ancestor, group in groupby(dp_sys_list, key=lambda x: x[0]):
-            group = list(group)
-            assert ancestor, 'ancestor should not be empty'
-            dataset = group[0][1]
-            for _a, dp_sys in group[1:]:
-                dataset += dp_sys
-            dataset.to_deepmd_npy(dataset_dir / ancestor, set_size=len(dataset), type_map=self.type_map)  # type: ignore
+        dump_dataset_manifest(str(dataset_dir))
+
+    def _parse_cp2k_dir(self, cp2k_dir: str, label_dir: str, parsed_dir: str):
+        """
+        Parse the output of a cp2k task, the result is cached in `output.npz` under parsed_dir
+        with the same relative path as the task in label_dir,
+        so that the parsed tasks will be skipped when the step is rerun.
+
+        :return: (ancestor, dp_sys, error), error is the traceback if failed
+        """
+        try:
+            cache_file = os.path.join(parsed_dir, os.path.relpath(cp2k_dir, label_dir), PARSED_CACHE)
+            cp2k_dir = unpack_persist_dir(cp2k_dir, label_dir)
+            ancestor = load_text(f'{cp2k_dir}/ANCESTOR')
+            output_file = f'{cp2k_dir}/output'
+            dp_sys = _load_parsed_cache(cache_file, output_file, self.type_map)
+            if dp_sys is None:
+                import dpdata
+                dp_sys = dpdata.LabeledSystem(output_file, fmt='cp2k/output', type_map=self.type_map)
+                _dump_parsed_cache(cache_file, output_file, dp_sys, self.type_map)
+            return ancestor, dp_sys, None
+        except Exception:
+            return None, None, traceback.format_exc()
+
+
+def append_deepmd_npy(dp_sys: 'dpdata.LabeledSystem', dataset_dir: Path, type_map: List[str]):
+    """
+    Append a system to a dataset in deepmd/npy format as a new set, e.g. `set.001`,
+    so that the cost of appending doesn't grow with the size of dataset.
+
+    :param dp_sys: the system to append
+    :param dataset_dir: the dataset dir, will be created if not exists
+    :param type_map: the type map of the dataset
+    """
+    # the order of atoms should be the same in all sets
+    dp_sys.sort_atom_types()
+    tmp_dir = Path(tempfile.mkdtemp(prefix='.tmp-', dir=dataset_dir.parent))
+    try:
+        dp_sys.to_deepmd_npy(str(tmp_dir), set_size=len(dp_sys), type_map=type_map)  # type: ignore
+        if not dataset_dir.exists():
+            os.rename(tmp_dir, dataset_dir)
+            return
+        for raw_file in ['type.raw', 'type_map.raw']:
+            assert (tmp_dir / raw_file).read_text() == (dataset_dir / raw_file).read_text(), \
+                f'{raw_file} of the system is not consistent with the dataset {dataset_dir}'
+        n_sets = len(glob.glob(f'{dataset_dir}/set.*'))
+        os.rename(tmp_dir / 'set.000', dataset_dir / f'set.{n_sets:03d}')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def dump_dataset_manifest(dataset_dir: str) -> str:
+    """
+    Write the sha256 of each file in the dataset to `MANIFEST` in the format of `sha256sum`.
+
+    :return: the sha256 of the manifest, which is used as the content key of the dataset
+    """
+    lines = []
+    for root, dirs, files in os.walk(dataset_dir):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            rel_path = os.path.relpath(path, dataset_dir)
+            if rel_path != DATASET_MANIFEST:
+                lines.append(f'{hash_path(path)}  {rel_path}\n')
+    manifest_file = os.path.join(dataset_dir, DATASET_MANIFEST)
+    dump_text(''.join(lines), manifest_file)
+    return hash_path(manifest_file)
+
+
+def fill_dataset_cache(dataset_dir: str, cache_dir: str, dataset_key: str):
+    """
+    Copy a dataset to `cache_dir/<dataset_key>` if it is not in the cache,
+    it is copied to a temp dir and then renamed to avoid partial dataset in cache.
+    """
+    cache_path = os.path.join(cache_dir, dataset_key)
+    if os.path.isdir(cache_path):
+        return
+    logger.info(f'Fill dataset cache: {cache_path}')
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f'.tmp-{dataset_key}-', dir=cache_dir)
+    try:
+        shutil.copytree(dataset_dir, tmp_dir, dirs_exist_ok=True)
+        os.rename(tmp_dir, cache_path)
+    except OSError:
+        # the dataset may have been cached by others
+        if not os.path.isdir(cache_path):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _dump_parsed_cache(cache_file: str, output_file: str, dp_sys: 'dpdata.LabeledSystem', type_map: List[str]):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f'{cache_file}.tmp.npz'
+        np.savez(tmp_file, __type_map__=np.array(type_map), __output_hash__=np.array(hash_path(output_file)),
+                 **dp_sys.data)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # the cache is optional, e.g. the dir may be read-only
+        logger.warning(f'Failed to write cache: {cache_file}', exc_info=True)
+
+
+def _load_parsed_cache(cache_file: str, output_file: str, type_map: List[str]) -> Optional['dpdata.LabeledSystem']:
+    """
+    Load the parsed result from cache, return None if the cache is missing or outdated.
+    The cache is validated by the content hash of output, as mtime is not kept by artifact transfer.
+    """
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as npz:
+        if npz['__type_map__'].tolist() != list(type_map) or '__output_hash__' not in npz.files or \
+                str(npz['__output_hash__']) != hash_path(output_file):
+            return None
+        data = {k: npz[k] for k in npz.files if k not in ('__type_map__', '__output_hash__')}
+    import dpdata
+    data['atom_names'] = data['atom_names'].tolist()
+    data['atom_numbs'] = data['atom_numbs'].tolist()
+    if 'nopbc' in data:
+        data['nopbc'] = bool(data['nopbc'])
+    return dpdata.LabeledSystem(data=data)
 
 
 @dataclass(frozen=True)
@@ -96,11 +264,22 @@ class SetupDeepmdTasksArgs:
 
 
 class SetupDeepmdTaskFn:
-    def __init__(self, config: DeepmdConfig, type_map: List[str]):
+    def __init__(self, config: DeepmdConfig, type_map: List[str], concurrency: int, warm_start: bool = False,
+                 dataset_cache_dir: Optional[str] = None):
+        """
+        :param warm_start: whether the models will be initialized from the previous iteration
+        :param dataset_cache_dir: the resolved dataset cache dir on the executor,
+            the datasets missing in it are copied from iter_dataset_dir if it is set.
+        """
         self.config = config
         self.type_map = type_map
+        self.concurrency = concurrency
+        self.warm_start = warm_start
+        self.dataset_cache_dir = dataset_cache_dir
+
+    def __call__(self, args: SetupDeepmdTasksArgs) -> SetupTasksResult:
+        from ai2_kit.domain.deepmd import make_deepmd_task_dirs
 
-    def __call__(self, args: SetupDeepmdTasksArgs):
         # dflow didn't provide a unified file namespace,
         # so we have to link dataset to a fixed path and use relative path to access it
         safe_ln(args.init_dataset_dir, INIT_DATASET_DIR)
@@ -109,9 +288,15 @@ class SetupDeepmdTaskFn:
         inspect_dir(ITER_DATASET_DIR)
 
         train_dataset_dirs = [ f'{INIT_DATASET_DIR}/{ds}' for ds in self.config.init_dataset]
-        train_dataset_dirs.extend(glob.glob(f'{ITER_DATASET_DIR}/*/*'))
+        # only dirs are datasets, the MANIFEST of each iteration should be excluded
+        train_dataset_dirs.extend(d.rstrip('/') for d in glob.glob(f'{ITER_DATASET_DIR}/*/*/'))
 
-        make_deepmd_task_dirs(input_template=self.config.input_template,
+        input_template = self.config.input_template
+        if self.warm_start and self.config.warm_start_numb_steps:
+            input_template = copy.deepcopy(input_template)
+            input_template.setdefault('training', {})['numb_steps'] = self.config.warm_start_numb_steps
+
+        make_deepmd_task_dirs(input_template=input_template,
                               model_num=self.config.model_num,
                               train_systems=train_dataset_dirs,
                               type_map=self.type_map,
@@ -123,48 +308,90 @@ class SetupDeepmdTaskFn:
                               outlier_weight=-1.0,
                               dw_input_template=None,
                               )
+        # index the iter datasets by the hash of their manifest,
+        # so that training tasks can find them in the dataset cache
+        index = []
+        for dataset_dir in sorted(glob.glob(f'{ITER_DATASET_DIR}/*/')):
+            manifest_file = os.path.join(dataset_dir, DATASET_MANIFEST)
+            if os.path.exists(manifest_file):
+                dataset_key = hash_path(manifest_file)
+                index.append(f'{dataset_key} {os.path.basename(dataset_dir.rstrip("/"))}\n')
+                if self.dataset_cache_dir:
+                    fill_dataset_cache(dataset_dir, self.dataset_cache_dir, dataset_key)
+            else:
+                logger.warning(f'No manifest is found in {dataset_dir}, it cannot be cached')
+        index_file = os.path.join(args.work_dir, DATASET_INDEX)
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        dump_text(''.join(index), index_file)
+
+        slices = split_task_dirs(args.work_dir, self.concurrency, shared_dirs=[os.path.dirname(DATASET_INDEX)])
+        return SetupTasksResult(slices=slices)
 
 
 @dataclass(frozen=True)
 class RunDeepmdTrainingArgs:
-    slice_idx: types.InputParam[types.SliceIndex]
-
     init_dataset_dir: types.InputArtifact
     iter_dataset_dir: types.InputArtifact
 
     work_dir: types.InputArtifact
     persist_dir: types.OutputArtifact
 
+    previous_dir: Optional[types.InputArtifact] = None
+    """
+    The models of the same slice in the previous iteration, the models are warm started from it if it is provided
+    """
+
 
 class RunDeepmdTrainingFn:
-    def __init__(self, config: DeepmdConfig, context: DeepmdApp):
+    def __init__(self, config: DeepmdConfig, context: DeepmdApp, dataset_cache_dir: Optional[str] = None,
+                 warm_start: bool = False):
+        """
+        :param dataset_cache_dir: the resolved dataset cache dir on the executor,
+            iter_dataset_dir is supposed to be the dataset of the current iteration if it is set.
+        :param warm_start: initialize the models from previous_dir
+        """
         self.config = config
         self.context = context
+        self.dataset_cache_dir = dataset_cache_dir
+        self.warm_start = warm_start
 
     def __call__(self, args: RunDeepmdTrainingArgs):
         """generate bash script to run deepmd training commands"""
-        c = self.context.concurrency
-
+        iter_dataset_dir = args.iter_dataset_dir
         script = [
             f'mkdir -p {args.persist_dir}',
             bash_inspect_dir(args.work_dir),
             f"pushd {args.work_dir}",
-            bash_iter_ls_slice(
-                'tasks/*/', opt='-d', n=c, i=args.slice_idx, it_var='ITEM',
+        ]
+        if self.dataset_cache_dir:
+            iter_dataset_dir = '$ITER_DATASET_SRC'
+            script += [
+                'ITER_DATASET_SRC=$PWD/iter-dataset',
+                bash_sync_dataset_cache(args.iter_dataset_dir, self.dataset_cache_dir,
+                                        DATASET_INDEX, iter_dataset_dir),
+            ]
+        script += [
+            bash_iter_ls(
+                'tasks/*/', opt='-d', it_var='ITEM',
                 script=[
                     '# dp train',
                     'pushd $ITEM',
                     'mv persist/* . || true  # recover checkpoint',
+                    f'PERSIST_DIR={args.persist_dir}/$ITEM/persist/',
+                    'mkdir -p $PERSIST_DIR',
+                    'cp -rn $PERSIST_DIR/. . || true  # recover checkpoint synced by previous attempt',
                     bash_ln_cmd(args.init_dataset_dir, INIT_DATASET_DIR),
-                    bash_ln_cmd(args.iter_dataset_dir, ITER_DATASET_DIR),
+                    bash_ln_cmd(iter_dataset_dir, ITER_DATASET_DIR),
                     '',
+                    *(self._build_init_model_script(args.previous_dir) if self.warm_start else []),
+                    *self._build_sync_checkpoint_script(),
                     self._build_dp_train_script(),
+                    *([self._build_stop_sync_checkpoint_script()] if self.context.checkpoint_interval > 0 else []),
                     '',
                     '# persist result',
-                    f'PERSIST_DIR={args.persist_dir}/$ITEM/persist/',
-                    'mkdir -p $PERSIST_DIR',
-                    'rm model.ckpt* || true',
+                    'rm -f model.ckpt* checkpoint $PERSIST_DIR/model.ckpt* $PERSIST_DIR/checkpoint',
                     'mv *.* $PERSIST_DIR',
+                    *self._build_persist_model_script(args.persist_dir),
                     'popd',
                 ]
             ),
@@ -172,10 +399,71 @@ class RunDeepmdTrainingFn:
         ]
         return script
 
+    def _build_persist_model_script(self, persist_dir: str):
+        """
+        Keep a copy of the model that can initialize training in `persist_dir/models`,
+        so that the next iteration can warm start without downloading the checkpoints and logs.
+        The original model is preferred as the compressed model cannot be used to initialize training.
+        """
+        return [
+            f'MODEL_DIR={persist_dir}/{DP_MODELS_DIR}/$ITEM',
+            'mkdir -p $MODEL_DIR',
+            f'MODEL_FILE=$PERSIST_DIR/{DP_ORIGINAL_MODEL}',
+            f'[ -f $MODEL_FILE ] || MODEL_FILE=$PERSIST_DIR/{DP_FROZEN_MODEL}',
+            'cp $MODEL_FILE $MODEL_DIR',
+        ]
+
+    def _build_init_model_script(self, previous_dir: str):
+        """
+        Find the model of the same task in the models persisted by the same slice of the previous iteration.
+        """
+        return [
+            '# find the model of previous iteration',
+            f'INIT_MODEL={previous_dir}/$ITEM/{DP_ORIGINAL_MODEL}',
+            f'[ -f $INIT_MODEL ] || INIT_MODEL={previous_dir}/$ITEM/{DP_FROZEN_MODEL}',
+            '[ -f $INIT_MODEL ] || { echo "no model of $ITEM is found in previous iteration" >&2; exit 1; }',
+        ]
+
+    def _build_sync_checkpoint_script(self):
+        """
+        Sync checkpoints to PERSIST_DIR periodically in background until the training is done,
+        the checkpoints that have been removed by training are also removed from PERSIST_DIR.
+        The loop also exits when the shell that starts it exits, so that it won't outlive a failed training.
+        Its output is detached and its sleep is killed along with it, so that it won't hold the output of step.
+        """
+        if self.context.checkpoint_interval <= 0:
+            return []
+        return [
+            '# sync checkpoints in background',
+            'SYNC_CKPT_PID=',
+            'if [ ! -f dp-train.done ]; then',
+            'SYNC_CKPT_PARENT=$BASHPID',
+            '(',
+            'trap \'kill $! 2> /dev/null; exit 0\' TERM',
+            'while kill -0 $SYNC_CKPT_PARENT 2> /dev/null; do',
+            f'    sleep {self.context.checkpoint_interval * 60} & wait $!',
+            '    cp -f model.ckpt* checkpoint $PERSIST_DIR 2> /dev/null || true',
+            '    (cd $PERSIST_DIR && for f in model.ckpt*; do [ -e "$OLDPWD/$f" ] || rm -f "$f"; done)',
+            'done',
+            ') > /dev/null 2>&1 &',
+            'SYNC_CKPT_PID=$!',
+            'fi',
+        ]
+
+    def _build_stop_sync_checkpoint_script(self):
+        """
+        Stop the sync loop and wait for it, so that it won't write PERSIST_DIR when the result is persisted.
+        """
+        return '[ -z "$SYNC_CKPT_PID" ] || { kill $SYNC_CKPT_PID && wait $SYNC_CKPT_PID; } 2> /dev/null || true'
+
     def _build_dp_train_script(self):
         dp_cmd = self.context.dp_cmd
         train_cmd = f'{dp_cmd} train {DP_INPUT_FILE}'
-        # TODO: handle restart, initialize from previous model, support pretrain model
+        if self.warm_start:
+            train_cmd += ' --init-frz-model $INIT_MODEL'
+        # restart from the latest checkpoint if training was interrupted
+        train_cmd = f'if [ -f checkpoint ]; then {dp_cmd} train {DP_INPUT_FILE} --restart model.ckpt; else {train_cmd}; fi'
+        # TODO: support pretrain model
         script = [
             cmd_cp(train_cmd, 'dp-train.done'),
             cmd_cp(f'{dp_cmd} freeze -o {DP_ORIGINAL_MODEL}', 'dp-freeze.done'),
@@ -190,7 +478,38 @@ class RunDeepmdTrainingFn:
         return '\n'.join(script)
 
 
-def provision_deepmd(builder: DFlowBuilder, ns: str, /,
+def bash_sync_dataset_cache(src_dir: str, cache_dir: str, index_file: str, link_dir: str):
+    """
+    Generate a bash snippet to sync datasets with a cache dir that is shared by tasks across iterations.
+
+    Datasets in src_dir, which can be a single dataset or a dir of datasets, are copied to
+    `cache_dir/<key>` if they are not in the cache, where key is the sha256 of their manifest.
+    Then the datasets listed in index_file, each line of which is `<key> <name>`,
+    are linked to `link_dir/<name>`.
+    The datasets missing in the cache have been filled by the setup step (see `fill_dataset_cache`),
+    so a dataset is missing here only if the cache is cleaned during the step, it fails the task in that case
+    and the retry of the iteration will fill the cache again.
+    """
+    return f"""# sync datasets with cache
+mkdir -p {cache_dir} {link_dir}
+for MANIFEST_FILE in $(ls {src_dir}/{DATASET_MANIFEST} {src_dir}/*/{DATASET_MANIFEST} 2> /dev/null); do
+    DATASET_KEY=$(sha256sum $MANIFEST_FILE | cut -d ' ' -f 1)
+    if [ ! -d {cache_dir}/$DATASET_KEY ]; then
+        # copy to a temp dir and rename it to avoid partial dataset in cache
+        cp -rL $(dirname $MANIFEST_FILE) {cache_dir}/.tmp-$DATASET_KEY-$$
+        mv -T {cache_dir}/.tmp-$DATASET_KEY-$$ {cache_dir}/$DATASET_KEY 2> /dev/null || rm -rf {cache_dir}/.tmp-$DATASET_KEY-$$
+    fi
+done
+while read -r DATASET_KEY DATASET_NAME; do
+    if [ ! -d {cache_dir}/$DATASET_KEY ]; then
+        echo "dataset $DATASET_NAME ($DATASET_KEY) is not found in {cache_dir}, rerun the iteration to fill it" >&2
+        exit 1
+    fi
+    ln -sfT {cache_dir}/$DATASET_KEY {link_dir}/$DATASET_NAME
+done < {index_file}"""
+
+
+def provision_deepmd(builder: 'DFlowBuilder', ns: str, /,
                      config: DeepmdConfig,
                      executor: ExecutorConfig,
                      deepmd_app: DeepmdApp,
@@ -204,22 +523,41 @@ def provision_deepmd(builder: DFlowBuilder, ns: str, /,
                      iter_dataset_url: str,
                      iter_str: str,
                      type_map: List[str],
+                     previous_train_url: Optional[str] = None,
                      ):
+    warm_start = config.warm_start and previous_train_url is not None
     if label_app and label_dir_url:
-        update_dataset_fn = UpdateDatasetFn(config, iter_str=iter_str,
-                                            label_app=label_app, type_map=type_map)
+        update_dataset_fn = UpdateDatasetFn(config, iter_str=iter_str, label_app=label_app,
+                                            type_map=type_map, workers=python_app.max_worker)
         update_dataset_step = builder.make_python_step(update_dataset_fn, uid=f'{ns}-update-dataset',
                                                        setup_script=python_app.setup_script,
                                                        executor=create_dispatcher(executor, python_app.resource))(
             UpdateDatasetArgs(
                 label_dir=label_dir_url,
                 iter_dataset_dir=iter_dataset_url,
+                # persist the parsed outputs next to the label outputs
+                parsed_dir=f'{label_dir_url}-parsed',
+                prev_parsed_dir=f'{label_dir_url}-parsed',
             )
 
         )
         builder.add_step(update_dataset_step)
 
-    setup_tasks_fn = SetupDeepmdTaskFn(config, type_map)
+    if deepmd_app.checkpoint_interval > 0 and (executor.hpc is None or executor.hpc.clean):
+        raise ValueError('checkpoint_interval is only supported by hpc executor with clean disabled')
+
+    dataset_cache_dir = None
+    training_dataset_url = iter_dataset_url
+    if deepmd_app.dataset_cache_dir:
+        if executor.hpc is None:
+            raise ValueError('dataset_cache_dir is only supported by hpc executor')
+        dataset_cache_dir = os.path.join(executor.hpc.base_dir, deepmd_app.dataset_cache_dir)
+        if label_app and label_dir_url:
+            # the datasets of previous iterations are read from the cache, which is filled by the setup step
+            training_dataset_url = f'{iter_dataset_url}/{iter_str}'
+
+    setup_tasks_fn = SetupDeepmdTaskFn(config, type_map, concurrency=deepmd_app.concurrency, warm_start=warm_start,
+                                       dataset_cache_dir=dataset_cache_dir)
     setup_tasks_step = builder.make_python_step(setup_tasks_fn, uid=f'{ns}-setup-task',
                                                 setup_script=python_app.setup_script,
                                                 executor=create_dispatcher(executor, python_app.resource))(
@@ -229,17 +567,21 @@ def provision_deepmd(builder: DFlowBuilder, ns: str, /,
             work_dir=work_dir_url,
         )
     )
-    run_training_fn = RunDeepmdTrainingFn(config=config, context=deepmd_app)
+
+    run_training_fn = RunDeepmdTrainingFn(config=config, context=deepmd_app, dataset_cache_dir=dataset_cache_dir,
+                                          warm_start=warm_start)
     run_training_step = builder.make_bash_step(run_training_fn, uid=f'{ns}-run-training',
                                                setup_script=deepmd_app.setup_script,
-                                               with_param=argo_range(deepmd_app.concurrency),
+                                               with_param=setup_tasks_step.result.slices,
                                                executor=create_dispatcher(executor, deepmd_app.resource))(
         RunDeepmdTrainingArgs(
-            slice_idx="{{item}}",
             init_dataset_dir=init_dataset_url,
-            iter_dataset_dir=iter_dataset_url,
-            work_dir=work_dir_url,
-            persist_dir=work_dir_url,
+            iter_dataset_dir=training_dataset_url,
+            # each item only download and persist its own slice
+            work_dir=f'{work_dir_url}/slices/{{{{item}}}}',
+            persist_dir=f'{work_dir_url}/slices/{{{{item}}}}',
+            # tasks are sliced in the same way across iterations, so the slice only needs its own models
+            previous_dir=f'{previous_train_url}/slices/{{{{item}}}}/{DP_MODELS_DIR}' if warm_start else None,
         )
     )
 
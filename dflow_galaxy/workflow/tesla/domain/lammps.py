@@ -1,24 +1,24 @@
-from typing import List, Optional, Mapping, Any, Literal
+from typing import List, Optional, Mapping, Any, Literal, TYPE_CHECKING
 from dataclasses import dataclass
 from copy import deepcopy
-import glob
+import shutil
 import os
 
 from dflow_galaxy.core.pydantic import BaseModel
 from dflow_galaxy.core.dispatcher import BaseApp, PythonApp, create_dispatcher, ExecutorConfig
-from dflow_galaxy.core.dflow_builder import DFlowBuilder
-from dflow_galaxy.core.util import bash_iter_ls_slice, safe_ln, bash_ln_cmd, inspect_dir, bash_inspect_dir
+from dflow_galaxy.core.util import bash_iter_ls, bash_iter_lock, safe_ln, bash_ln_cmd, inspect_dir, bash_inspect_dir
 from dflow_galaxy.core import types
 
-from ai2_kit.domain.lammps import make_lammps_task_dirs, FepOptions
 from ai2_kit.domain.constant import DP_FROZEN_MODEL
 from ai2_kit.core.artifact import Artifact, ArtifactDict
 from ai2_kit.core.util import cmd_with_checkpoint as cmd_cp, dump_text
 
-from dflow import argo_range
+from .lammpstrj import bash_pack_lammpstrj
+from .lib import resolve_artifact, glob_task_dirs, split_task_dirs, dump_task_cost, SetupTasksResult
+from .lib import bash_persist_task, bash_restore_task
 
-
-from .lib import resolve_artifact
+if TYPE_CHECKING:
+    from dflow_galaxy.core.dflow_builder import DFlowBuilder
 
 
 MODEL_DIR = './mlp-models'
@@ -28,6 +28,19 @@ SYSTEM_DIR = './systems'
 class LammpsApp(BaseApp):
     lammps_cmd: str = 'lmp'
     concurrency: int = 5
+    """
+    Max number of slices to run tasks in parallel, one slice per task if it is not positive.
+    """
+    tasks_per_pod: int = 1
+    """
+    Max number of tasks to run in parallel in the same pod,
+    the resource requested by each task should be taken into account when setting the command.
+    """
+    pack_outputs: bool = False
+    """
+    Pack the outputs of each task into a single tar.gz before persisting,
+    which reduces the number of objects to upload and download.
+    """
 
 
 class LammpsConfig(BaseModel):
@@ -66,13 +79,17 @@ class SetupLammpsTasksFn:
     def __init__(self, config: LammpsConfig,
                  type_map: List[str],
                  mass_map: List[float],
-                 systems: Mapping[str, Artifact]):
+                 systems: Mapping[str, Artifact],
+                 concurrency: int):
         self.config = config
         self.type_map = type_map
         self.mass_map = mass_map
         self.systems = systems
+        self.concurrency = concurrency
+
+    def __call__(self, args: SetupLammpsTasksArgs) -> SetupTasksResult:
+        from ai2_kit.domain.lammps import make_lammps_task_dirs, FepOptions
 
-    def __call__(self, args: SetupLammpsTasksArgs):
         # dflow didn't provide a unified file namespace,
         # so we have to link dataset to a fixed path and use relative path to access it
         safe_ln(args.model_dir, MODEL_DIR)
@@ -88,9 +105,8 @@ class SetupLammpsTasksFn:
             data_files.extend(resolve_artifact(v))
 
         # resolve model files
-        search_pattern = f'{MODEL_DIR}/tasks/*/persist/{DP_FROZEN_MODEL}'
-        model_files = glob.glob(search_pattern)
-        assert model_files, f'no model files found in {search_pattern}'
+        model_files = glob_task_dirs(MODEL_DIR, f'persist/{DP_FROZEN_MODEL}')
+        assert model_files, f'no model files found in {MODEL_DIR}'
 
         # handle default value
         default_vars = {
@@ -131,14 +147,35 @@ class SetupLammpsTasksFn:
             fep_opts=FepOptions(),
         )
         # write ancestor to the task dirs
+        task_files = {}
         for task_dir in task_dirs:
             path = os.path.join(task_dir['url'], 'ANCESTOR')
             dump_text(task_dir['attrs']['ancestor'], path)
+            # the cost of MD simulation scales linearly with the number of atoms and steps
+            n_atoms = _count_lammps_atoms(task_dir['attrs']['source'])
+            dump_task_cost(task_dir['url'], n_atoms * self.config.nsteps)
+            task_name = os.path.basename(os.path.normpath(task_dir['url']))
+            task_files[task_name] = [os.path.relpath(task_dir['attrs']['source'], args.work_dir)]
+        # data files are referenced by relative path, each slice only keeps the data files of its own tasks
+        slices = split_task_dirs(args.work_dir, self.concurrency, task_files=task_files)
+        shutil.rmtree(os.path.join(args.work_dir, 'input_data'))
+        return SetupTasksResult(slices=slices)
+
+
+def _count_lammps_atoms(data_file: str) -> int:
+    """
+    Read the number of atoms from the header of lammps data file.
+    """
+    with open(data_file) as fp:
+        for line in fp:
+            tokens = line.split()
+            if len(tokens) == 2 and tokens[1] == 'atoms':
+                return int(tokens[0])
+    raise ValueError(f'number of atoms not found in {data_file}')
 
 
 @dataclass(frozen=True)
 class RunLammpsTasksArgs:
-    slice_idx: types.InputParam[types.SliceIndex]
     model_dir: types.InputArtifact
     work_dir: types.InputArtifact
     persist_dir: types.OutputArtifact
@@ -150,26 +187,29 @@ class RunLammpsTasksFn:
         self.context = context
 
     def __call__(self, args: RunLammpsTasksArgs):
-        c = self.context.concurrency
-
         script = [
             f'mkdir -p {args.persist_dir} && touch {args.persist_dir}/.placeholder',
             bash_inspect_dir(args.work_dir),
             f"pushd {args.work_dir}",
-            bash_iter_ls_slice(
-                'tasks/*/', opt='-d', n=c, i=args.slice_idx, it_var='ITEM',
+            bash_iter_ls(
+                'tasks/*/', opt='-d', it_var='ITEM', workers=self.context.tasks_per_pod,
                 script=[
                     '# run lammps',
                     'pushd $ITEM',
                     bash_ln_cmd(args.model_dir, MODEL_DIR),
-                    'mv persist/* . || true  # restore previous state',
+                    bash_restore_task(),
                     '',
                     self._build_lammps_cmd(),
                     '',
+                    bash_pack_lammpstrj('traj', 'traj.lammpstrj', 'traj.idx'),
+                    '',
                     '# persist result',
-                    f'PERSIST_DIR={args.persist_dir}/$ITEM/persist/',
-                    'mkdir -p $PERSIST_DIR',
-                    'mv *.done traj model_devi.out ANCESTOR $PERSIST_DIR',
+                    bash_iter_lock([
+                        f'PERSIST_DIR={args.persist_dir}/$ITEM/persist/',
+                        'mkdir -p $PERSIST_DIR',
+                        bash_persist_task('*.done traj.lammpstrj traj.idx model_devi.out ANCESTOR', '$PERSIST_DIR',
+                                          pack=self.context.pack_outputs),
+                    ]),
                     'popd',
                 ]
             ),
@@ -183,7 +223,7 @@ class RunLammpsTasksFn:
         return cmd_cp(cmd, 'lammps.done', ignore_error=self.config.ignore_error)
 
 
-def provision_lammps(builder: DFlowBuilder, ns: str, /,
+def provision_lammps(builder: 'DFlowBuilder', ns: str, /,
                      config: LammpsConfig,
                      executor: ExecutorConfig,
                      lammps_app: LammpsApp,
@@ -196,7 +236,8 @@ def provision_lammps(builder: DFlowBuilder, ns: str, /,
                      mass_map: List[float],
                      systems: Mapping[str, Artifact],
                      ):
-    setup_tasks_fn = SetupLammpsTasksFn(config, type_map=type_map, mass_map=mass_map, systems=systems)
+    setup_tasks_fn = SetupLammpsTasksFn(config, type_map=type_map, mass_map=mass_map, systems=systems,
+                                        concurrency=lammps_app.concurrency)
     setup_tasks_step = builder.make_python_step(setup_tasks_fn, uid=f'{ns}-setup-task',
                                                 setup_script=python_app.setup_script,
                                                 executor=create_dispatcher(executor, python_app.resource))(
@@ -210,15 +251,16 @@ def provision_lammps(builder: DFlowBuilder, ns: str, /,
     run_tasks_fn = RunLammpsTasksFn(config, lammps_app)
     run_tasks_step = builder.make_bash_step(run_tasks_fn, uid=f'{ns}-run-task',
                                             setup_script=lammps_app.setup_script,
-                                            with_param=argo_range(lammps_app.concurrency),
+                                            with_param=setup_tasks_step.result.slices,
                                             executor=create_dispatcher(executor, lammps_app.resource))(
         RunLammpsTasksArgs(
-            slice_idx='{{item}}',
             model_dir=mlp_model_url,
-            work_dir=work_dir_url,
-            persist_dir=work_dir_url,
+            # each item only download and persist its own slice
+            work_dir=f'{work_dir_url}/slices/{{{{item}}}}',
+            persist_dir=f'{work_dir_url}/slices/{{{{item}}}}',
         )
     )
 
     builder.add_step(setup_tasks_step)
     builder.add_step(run_tasks_step)
+    return setup_tasks_step.result.slices
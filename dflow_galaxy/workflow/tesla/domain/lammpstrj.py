@@ -0,0 +1,185 @@
+from typing import Iterable, Iterator, List, TextIO
+from collections import namedtuple
+import io
+
+import numpy as np
+
+
+LammpsFrame = namedtuple('LammpsFrame', ['timestep', 'cell', 'origin', 'pbc', 'columns', 'data'])
+
+
+def iter_lammpstrj_frames(fp: TextIO) -> Iterator[LammpsFrame]:
+    """
+    Read frames from a lammps dump file in text format one at a time,
+    so that the memory usage is bounded by the size of a single frame.
+
+    :param fp: file object of the lammps dump file
+    """
+    timestep, n_atoms, cell, origin, pbc = 0, 0, None, None, None
+    while True:
+        line = fp.readline()
+        if not line:
+            return
+        if line.startswith('ITEM: TIMESTEP'):
+            timestep = int(fp.readline().split()[0])
+        elif line.startswith('ITEM: NUMBER OF ATOMS'):
+            n_atoms = int(fp.readline())
+        elif line.startswith('ITEM: BOX BOUNDS'):
+            tokens = line.split()[3:]
+            pbc = [b.startswith('p') for b in tokens[-3:]]
+            bounds = [[float(v) for v in fp.readline().split()] for _ in range(3)]
+            cell, origin = _get_cell(bounds)
+        elif line.startswith('ITEM: ATOMS'):
+            columns = line.split()[2:]
+            lines = [fp.readline() for _ in range(n_atoms)]
+            data = np.array(''.join(lines).split(), dtype=object).reshape(n_atoms, len(columns))
+            yield LammpsFrame(timestep=timestep, cell=cell, origin=origin, pbc=pbc, columns=columns, data=data)
+
+
+def _get_cell(bounds: List[List[float]]):
+    """
+    Convert the box bounds of lammps dump to cell vectors and origin.
+    https://docs.lammps.org/Howto_triclinic.html
+    """
+    (xlo, xhi, *xy), (ylo, yhi, *xz), (zlo, zhi, *yz) = bounds
+    xy = xy[0] if xy else 0.
+    xz = xz[0] if xz else 0.
+    yz = yz[0] if yz else 0.
+    xlo -= min(0., xy, xz, xy + xz)
+    xhi -= max(0., xy, xz, xy + xz)
+    ylo -= min(0., yz)
+    yhi -= max(0., yz)
+    cell = np.array([
+        [xhi - xlo, 0., 0.],
+        [xy, yhi - ylo, 0.],
+        [xz, yz, zhi - zlo],
+    ])
+    return cell, np.array([xlo, ylo, zlo])
+
+
+def write_extxyz_frame(fp: TextIO, frame: LammpsFrame, type_map: List[str]):
+    """
+    Write a lammps frame to extxyz file, atoms are sorted by id.
+    The species are taken from the `element` column if it is dumped (the same as ASE does),
+    otherwise they are mapped from the `type` column with type_map.
+
+    :param fp: file object of the extxyz file
+    :param frame: the frame to write
+    :param type_map: the element of each lammps type, e.g. ['O', 'H'] means type 1 is O and type 2 is H
+    """
+    columns, data = frame.columns, frame.data
+    if 'id' in columns:
+        data = data[np.argsort(data[:, columns.index('id')].astype(int), kind='stable')]
+
+    def _get(*names):
+        return data[:, [columns.index(name) for name in names]].astype(float)
+
+    if 'x' in columns:
+        pos = _get('x', 'y', 'z')
+    elif 'xu' in columns:
+        pos = _get('xu', 'yu', 'zu')
+    elif 'xs' in columns:
+        pos = _get('xs', 'ys', 'zs') @ frame.cell + frame.origin
+    else:
+        raise ValueError(f'no position is found in columns: {columns}')
+
+    if 'element' in columns:
+        species = data[:, columns.index('element')]
+    else:
+        species = np.array(type_map, dtype=object)[data[:, columns.index('type')].astype(int) - 1]
+    properties = 'species:S:1:pos:R:3'
+    fields = [pos]
+    if 'fx' in columns:
+        properties += ':forces:R:3'
+        fields.append(_get('fx', 'fy', 'fz'))
+    values = np.hstack(fields)
+
+    lattice = ' '.join(f'{v:.8f}' for v in frame.cell.flatten())
+    pbc = ' '.join('T' if p else 'F' for p in frame.pbc)
+    fp.write(f'{len(data)}\n')
+    fp.write(f'Lattice="{lattice}" Properties={properties} timestep={frame.timestep} pbc="{pbc}"\n')
+    # format the whole frame at once, which is much faster than formatting row by row
+    rows = np.empty((len(data), values.shape[1] + 1), dtype=object)
+    rows[:, 0] = species
+    rows[:, 1:] = values
+    row_fmt = '%-2s' + ' %16.8f' * values.shape[1] + '\n'
+    fp.write((row_fmt * len(rows)) % tuple(rows.ravel().tolist()))
+
+
+def lammpstrj_to_extxyz(lammpstrj_files: Iterable[str], xyz_file: str, type_map: List[str]) -> int:
+    """
+    Convert lammps dump files to a single extxyz file frame by frame.
+
+    :param lammpstrj_files: the lammps dump files in text format
+    :param xyz_file: the output extxyz file
+    :param type_map: the element of each lammps type
+    :return: the number of frames written
+    """
+    return dump_frames_to_extxyz(iter_lammpstrj_files(lammpstrj_files), xyz_file, type_map)
+
+
+def dump_frames_to_extxyz(frames: Iterable[LammpsFrame], xyz_file: str, type_map: List[str]) -> int:
+    """
+    Write lammps frames to a single extxyz file.
+
+    :return: the number of frames written
+    """
+    n_frames = 0
+    with open(xyz_file, 'w') as fp:
+        for frame in frames:
+            write_extxyz_frame(fp, frame, type_map)
+            n_frames += 1
+    return n_frames
+
+
+def iter_lammpstrj_files(lammpstrj_files: Iterable[str]) -> Iterator[LammpsFrame]:
+    for lammpstrj_file in lammpstrj_files:
+        with open(lammpstrj_file, 'r') as fp:
+            yield from iter_lammpstrj_frames(fp)
+
+
+def bash_pack_lammpstrj(traj_dir: str = 'traj', trj_file: str = 'traj.lammpstrj', idx_file: str = 'traj.idx'):
+    """
+    Generate a bash snippet to pack the per-frame dump files, e.g. `traj/100.lammpstrj`,
+    into a single dump file, and write the index of frames to idx_file,
+    each line of which is `<frame_no> <byte offset> <byte size>`, sorted by frame_no.
+    The traj_dir will be removed after packing, it's a no-op if traj_dir doesn't exist.
+
+    :param traj_dir: the dir of per-frame dump files
+    :param trj_file: the packed dump file
+    :param idx_file: the index file
+    """
+    lst_file = f'{idx_file}.lst'
+    return f"""# pack {traj_dir}/*.lammpstrj into {trj_file}
+if [ -d {traj_dir} ]; then
+(cd {traj_dir} && ls -1 | grep '\\.lammpstrj$' | sort -n | xargs -r wc -c | grep -v ' total$' || true) > {lst_file}
+awk '{{split($2, a, "."); print a[1], s + 0, $1; s += $1}}' {lst_file} > {idx_file}
+awk '{{print "{traj_dir}/" $2}}' {lst_file} | xargs -r cat > {trj_file}
+rm -rf {traj_dir} {lst_file}
+fi"""
+
+
+def load_lammpstrj_index(idx_file: str) -> np.ndarray:
+    """
+    Load the index written by `bash_pack_lammpstrj`.
+
+    :return: array of shape (n_frames, 3), each row is (frame_no, offset, size)
+    """
+    return np.loadtxt(idx_file, dtype=np.int64, ndmin=2).reshape(-1, 3)
+
+
+def iter_packed_lammpstrj(trj_file: str, idx_file: str, indices: Iterable[int]) -> Iterator[LammpsFrame]:
+    """
+    Read the selected frames from a packed dump file by seeking to their offsets.
+
+    :param trj_file: the packed dump file
+    :param idx_file: the index file
+    :param indices: the positions of frames in the index, e.g. the row numbers of model_devi.out
+    """
+    index = load_lammpstrj_index(idx_file)
+    with open(trj_file, 'rb') as fp:
+        for i in indices:
+            _frame_no, offset, size = index[i]
+            fp.seek(int(offset))
+            text = fp.read(int(size)).decode()
+            yield from iter_lammpstrj_frames(io.StringIO(text))
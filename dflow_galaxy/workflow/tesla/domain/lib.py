@@ -1,7 +1,12 @@
-from typing import List, Literal
+from typing import List, Literal, Iterable, Mapping, Optional
+from dataclasses import dataclass
 from ai2_kit.core.artifact import Artifact, ArtifactDict
+import tarfile
+import shutil
 import glob
-from dflow_galaxy.core.util import yes_or_no
+import os
+from dflow_galaxy.core.util import yes_or_no, lpt_partition
+from dflow_galaxy.core import types
 
 
 LabelApp = Literal['cp2k', 'vasp', 'abacus', 'dpa2']
@@ -25,6 +30,138 @@ def resolve_artifacts(a_list: List[Artifact]) -> List[ArtifactDict]:
     return result
 
 
+def glob_task_dirs(base_dir: str, suffix: str = '') -> List[str]:
+    """
+    Find the task dirs in base_dir, both the flat layout `tasks/*`
+    and the sliced layout `slices/*/tasks/*` are supported.
+
+    :param base_dir: the work dir of tasks
+    :param suffix: the path relative to the task dir to search
+    """
+    patterns = [f'{base_dir}/tasks/*/{suffix}', f'{base_dir}/slices/*/tasks/*/{suffix}']
+    return sorted(path.rstrip('/') for pattern in patterns for path in glob.glob(pattern))
+
+
+TASK_COST_FILE = 'COST'
+
+
+def dump_task_cost(task_dir: str, cost: float):
+    """
+    Write the estimated cost of a task, which is used to balance the slices of tasks.
+    """
+    with open(os.path.join(task_dir, TASK_COST_FILE), 'w') as fp:
+        fp.write(str(cost))
+
+
+def load_task_cost(task_dir: str) -> float:
+    """
+    Read the estimated cost of a task, default to 1 if it is not provided.
+    """
+    path = os.path.join(task_dir, TASK_COST_FILE)
+    if not os.path.isfile(path):
+        return 1.0
+    with open(path) as fp:
+        return float(fp.read().strip() or 1)
+
+
+TASK_ARCHIVE = 'persist.tar.gz'
+UNPACK_DIR = './unpacked'
+
+
+def bash_persist_task(files: str, persist_dir: str, pack: bool = False):
+    """
+    Generate a bash snippet to move the outputs of a task to persist_dir.
+
+    If pack is True, the outputs are packed into a single tar.gz with fast compression instead,
+    so that there will be only one object to upload for each task.
+
+    :param files: the files to persist, shell pattern is supported
+    :param persist_dir: the persist dir of the task
+    :param pack: whether to pack the outputs
+    """
+    if pack:
+        return f'(set -o pipefail && tar -cf - {files} | gzip -1 > {persist_dir}/{TASK_ARCHIVE})'
+    return f'mv {files} {persist_dir}'
+
+
+def bash_restore_task():
+    """
+    Generate a bash snippet to restore the persisted outputs in the task dir,
+    both the plain and the packed form are supported.
+    """
+    return '\n'.join([
+        'mv persist/* . || true  # restore previous state',
+        f'if [ -f {TASK_ARCHIVE} ]; then tar -xzf {TASK_ARCHIVE} && rm {TASK_ARCHIVE}; fi',
+    ])
+
+
+def unpack_persist_dir(persist_dir: str, base_dir: str, unpack_dir: str = UNPACK_DIR) -> str:
+    """
+    Extract the outputs of a task if they are packed by `bash_persist_task`.
+
+    The outputs are extracted to unpack_dir with the path relative to base_dir,
+    so that the input artifacts won't be modified.
+
+    :param persist_dir: the persist dir of the task
+    :param base_dir: the base dir of tasks, e.g. the work dir of the upstream step
+    :param unpack_dir: the dir to extract outputs
+    :return: the dir contains the outputs
+    """
+    archive = os.path.join(persist_dir, TASK_ARCHIVE)
+    if not os.path.isfile(archive):
+        return persist_dir
+    out_dir = os.path.join(unpack_dir, os.path.relpath(persist_dir, base_dir))
+    os.makedirs(out_dir, exist_ok=True)
+    with tarfile.open(archive, 'r:*') as tar:
+        tar.extractall(out_dir)
+    return out_dir
+
+
+@dataclass
+class SetupTasksResult:
+    slices: types.OutputParam[List[str]]
+
+
+def split_task_dirs(work_dir: str, concurrency: int, shared_dirs: Iterable[str] = (),
+                    task_files: Optional[Mapping[str, Iterable[str]]] = None) -> List[str]:
+    """
+    Move the task dirs in `work_dir/tasks` into slices, e.g. `work_dir/slices/0/tasks`,
+    so that each item of the fan-out step only need to download the tasks of its own slice.
+    Tasks are assigned to slices by their cost (see `dump_task_cost`) to balance the load.
+
+    :param work_dir: the work dir of tasks
+    :param concurrency: max number of slices, the number of slices won't exceed the number of tasks,
+        one slice per task if it is not positive.
+    :param shared_dirs: dirs in work_dir that are referenced by tasks with relative path,
+        they will be moved into each slice so that the relative path is still valid.
+    :param task_files: files in work_dir that are referenced by tasks with relative path,
+        keyed by the name of task dir, the paths are relative to work_dir.
+        Unlike shared_dirs, they are copied into the slices of the tasks that reference them,
+        so that each slice only gets the files of its own tasks.
+    :return: the names of slices, which is supposed to be used as `with_param` of the fan-out step
+    """
+    task_dirs = sorted(glob.glob(f'{work_dir}/tasks/*/'))
+    n = len(task_dirs) if concurrency <= 0 else min(concurrency, len(task_dirs))
+    slices = []
+    chunks = lpt_partition([load_task_cost(task_dir) for task_dir in task_dirs], n) if n > 0 else []
+    for i, chunk in enumerate(chunks):
+        slice_dir = os.path.join(work_dir, 'slices', str(i))
+        os.makedirs(os.path.join(slice_dir, 'tasks'), exist_ok=True)
+        for k in chunk:
+            task_name = os.path.basename(task_dirs[k].rstrip('/'))
+            for path in (task_files or {}).get(task_name, []):
+                os.makedirs(os.path.dirname(os.path.join(slice_dir, path)), exist_ok=True)
+                shutil.copy2(os.path.join(work_dir, path), os.path.join(slice_dir, path))
+            shutil.move(task_dirs[k].rstrip('/'), os.path.join(slice_dir, 'tasks'))
+        for shared_dir in shared_dirs:
+            shutil.copytree(os.path.join(work_dir, shared_dir), os.path.join(slice_dir, shared_dir))
+        slices.append(str(i))
+    for path in ['tasks', *shared_dirs]:
+        if os.path.isdir(os.path.join(work_dir, path)):
+            shutil.rmtree(os.path.join(work_dir, path))
+    return slices
+
+
 class StepSwitch:
     def __init__(self, enable: bool):
         """
@@ -1,4 +1,4 @@
-from typing import List, Literal, Tuple
+from typing import Any, List, Literal, Tuple, TYPE_CHECKING
 from collections import namedtuple
 from dataclasses import dataclass
 from pathlib import Path
@@ -7,32 +7,41 @@ import glob
 import os
 import re
 
-from joblib import Parallel, delayed
-from tabulate import tabulate
-import pandas as pd
-import ase.io
+import numpy as np
 
 from dflow_galaxy.core.pydantic import BaseModel
 
 from dflow_galaxy.core.dispatcher import PythonApp, create_dispatcher, ExecutorConfig
-from dflow_galaxy.core.dflow_builder import DFlowBuilder
 from dflow_galaxy.core import types
 from dflow_galaxy.core.util import inspect_dir
 
 from ai2_kit.core.util import load_text, dump_text
 
-from .lib import ExploreApp
+from .lib import ExploreApp, glob_task_dirs, unpack_persist_dir
+from .lammpstrj import dump_frames_to_extxyz, iter_lammpstrj_files, iter_packed_lammpstrj
+
+if TYPE_CHECKING:
+    from dflow_galaxy.core.dflow_builder import DFlowBuilder
 
 
 class ModelDeviConfig(BaseModel):
     metric: Literal["max_devi_v",  "min_devi_v",  "avg_devi_v",  "max_devi_f",  "min_devi_f",  "avg_devi_f"] = 'max_devi_f'
     decent_range: Tuple[float, float]
+    concurrency: int = 1
+    """
+    Screen the slices of explore tasks in parallel if it is greater than 1,
+    each slice published by the explore step is a shard, and the results of shards are merged by a reduce step.
+    """
 
 
 @dataclass(frozen=True)
 class RunModelDeviTasksArgs:
     explore_dir: types.InputArtifact
     persist_dir: types.OutputArtifact
+    explore_slice: types.InputParam[str] = ''
+    """
+    The slice of explore tasks bound to explore_dir, e.g. `slices/0`, it's used as the prefix of src in report.
+    """
 
 ModelDeviResult = namedtuple('_ModelDeviResult', ['data_dir', 'decent_xyz', 'ancestor', 'total', 'n_good', 'n_decent', 'n_poor'])
 
@@ -45,91 +54,167 @@ class RunModelDeviTasksFn:
         self.explore_app = explore_app
 
     def __call__(self, args: RunModelDeviTasksArgs):
+        from joblib import Parallel, delayed
+
         inspect_dir(args.explore_dir)
         persis_dir = Path(args.persist_dir)
         persis_dir.mkdir(exist_ok=True)
         if self.explore_app == 'lammps':
-            data_dirs = sorted(glob.glob(f'{args.explore_dir}/tasks/*/persist'))
+            data_dirs = glob_task_dirs(args.explore_dir, 'persist')
             results: List[ModelDeviResult] = Parallel(n_jobs=self.workers)(
-                delayed(self._process_lammps_dir)(Path(d)) for d in data_dirs
+                delayed(self._process_lammps_dir)(Path(d), args.explore_dir) for d in data_dirs
             ) # type: ignore
         else:
             raise ValueError(f'unsupported explore app: {self.explore_app}')
 
-        # generate report
-        headers = ['src', 'total', 'good', 'decent', 'poor', 'good%', 'decent%', 'poor%']
-        rows = [ ]
-        _pp = lambda a, b: f'{a / b * 100:.2f}%'
-        for r in results:
-            row = [os.path.relpath(r.data_dir, args.explore_dir), r.total, r.n_good, r.n_decent, r.n_poor,
-                   _pp(r.n_good, r.total), _pp(r.n_decent, r.total), _pp(r.n_poor, r.total)]
-            rows.append(row)
-
-        report_text = tabulate(rows, headers=headers, tablefmt='tsv')
-        dump_text(report_text, str(persis_dir / 'report.tsv'))
+        rows = [[os.path.join(args.explore_slice, os.path.relpath(r.data_dir, args.explore_dir)),
+                 r.total, r.n_good, r.n_decent, r.n_poor] for r in results]
+        dump_report(rows, persis_dir)
 
         # dump decent xyz
         results = sorted(results, key=lambda r: r.ancestor)
         for ancestor, group in groupby(results, key=lambda r: r.ancestor):
             assert ancestor, f'ancestor should not be empty'
-            group = list(group)
-            assert group, f'group should not be empty'
             decent_xyz_files = [str(r.decent_xyz) for r in group if r.decent_xyz is not None]
-            if not decent_xyz_files:
-                print(f'no decent files for ancestor {ancestor}')
-                continue
-
-            result_dir: Path = persis_dir / 'system' / ancestor
-            result_dir.mkdir(parents=True, exist_ok=True)
-
-            # merge xyz files, use cat for the sake of performance
-            os.system(f'cat {" ".join(decent_xyz_files)} > {result_dir / "decent.xyz"}')
-            dump_text(ancestor, str(result_dir / 'ANCESTOR'))
+            dump_decent_xyz(ancestor, decent_xyz_files, persis_dir)
 
-    def _process_lammps_dir(self, data_dir: Path):
+    def _process_lammps_dir(self, persist_dir: Path, explore_dir: str):
         col = self.config.metric
+        data_dir = Path(unpack_persist_dir(str(persist_dir), explore_dir))
 
         model_devi_file = data_dir / 'model_devi.out'
-        traj_dir = data_dir / 'traj'
-
-        with open(model_devi_file, 'r') as f:
-            f.seek(1)  # skip the leading '#'
-            df = pd.read_csv(f, delim_whitespace=True)
         lo, hi = self.config.decent_range
+        stats = read_model_devi(model_devi_file, col, lo, hi)
 
-        good_df = df[df[col] < lo]
-        decent_df = df[(df[col] >= lo) & (df[col] < hi)]
-        poor_df = df[df[col] > hi]
-
-        traj_files = glob.glob(f'{traj_dir}/*.lammpstrj')
-        assert traj_files, f'no traj files is found in {traj_dir}'
-
-        # pick decent files
-        traj_files = sorted(traj_files, key=get_lammpstrj_frame_no)  # align
-        decent_files = [traj_files[i] for i in decent_df.index]
+        if (data_dir / 'traj.lammpstrj').exists():
+            # seek to the decent frames in the packed trajectory
+            frames = iter_packed_lammpstrj(str(data_dir / 'traj.lammpstrj'), str(data_dir / 'traj.idx'),
+                                           stats.decent_indices)
+        else:
+            traj_dir = data_dir / 'traj'
+            traj_files = glob.glob(f'{traj_dir}/*.lammpstrj')
+            assert traj_files, f'no traj files is found in {traj_dir}'
+            traj_files = sorted(traj_files, key=get_lammpstrj_frame_no)  # align
+            frames = iter_lammpstrj_files(traj_files[i] for i in stats.decent_indices)
 
-        # merge decent files
+        # merge decent frames
         decent_xyz = None
-        if len(decent_df) > 0:
-            decent_trj = data_dir / 'decent.lammpstrj'
+        if len(stats.decent_indices) > 0:
             decent_xyz = data_dir / 'decent.xyz'
-            # use cat for the sake of performance
-            os.system(f'cat {" ".join(decent_files)} > {decent_trj}')
-            self._dump_lammpstrj_to_xyz(decent_trj, decent_xyz)
+            dump_frames_to_extxyz(frames, str(decent_xyz), self.type_map)
 
         return ModelDeviResult(
-            data_dir=data_dir,
+            data_dir=persist_dir,
             decent_xyz=decent_xyz,
             ancestor=load_text(data_dir / 'ANCESTOR'),
-            total=len(df),
-            n_good=len(good_df),
-            n_decent=len(decent_df),
-            n_poor=len(poor_df),
+            total=stats.total,
+            n_good=stats.n_good,
+            n_decent=len(stats.decent_indices),
+            n_poor=stats.n_poor,
         )
 
-    def _dump_lammpstrj_to_xyz(self, lmptrj_file: Path, xyz_file: Path):
-        atoms_list = ase.io.read(lmptrj_file, ':', format='lammps-dump-text', specorder=self.type_map)
-        ase.io.write(xyz_file, atoms_list, format='extxyz')
+
+@dataclass(frozen=True)
+class MergeModelDeviShardsArgs:
+    shards_dir: types.InputArtifact
+    persist_dir: types.OutputArtifact
+
+
+class MergeModelDeviShardsFn:
+    """
+    Merge the report and decent structures of shards into the layout of a single screening step.
+    """
+
+    def __call__(self, args: MergeModelDeviShardsArgs):
+        inspect_dir(args.shards_dir)
+        persist_dir = Path(args.persist_dir)
+        persist_dir.mkdir(exist_ok=True)
+        shard_dirs = sorted(glob.glob(f'{args.shards_dir}/*/'), key=lambda d: int(os.path.basename(d.rstrip('/'))))
+
+        rows = []
+        for shard_dir in shard_dirs:
+            report_file = os.path.join(shard_dir, 'report.tsv')
+            if not os.path.exists(report_file):
+                continue
+            with open(report_file) as fp:
+                lines = fp.read().splitlines()[1:]  # skip header
+            for line in lines:
+                src, total, n_good, n_decent, n_poor = [v.strip() for v in line.split('\t')][:5]
+                rows.append([src, int(total), int(n_good), int(n_decent), int(n_poor)])
+        dump_report(sorted(rows, key=lambda row: row[0]), persist_dir)
+
+        decent_xyz_files = {}
+        for xyz_file in glob.glob(f'{args.shards_dir}/*/system/*/decent.xyz'):
+            ancestor = load_text(os.path.join(os.path.dirname(xyz_file), 'ANCESTOR'))
+            decent_xyz_files.setdefault(ancestor, []).append(xyz_file)
+        for ancestor, files in sorted(decent_xyz_files.items()):
+            dump_decent_xyz(ancestor, sorted(files), persist_dir)
+
+
+def dump_report(rows: List[list], persist_dir: Path):
+    """
+    Dump the screening report, each row is [src, total, good, decent, poor].
+    """
+    from tabulate import tabulate
+
+    headers = ['src', 'total', 'good', 'decent', 'poor', 'good%', 'decent%', 'poor%']
+    _pp = lambda a, b: f'{a / b * 100:.2f}%'
+    rows = [[src, total, n_good, n_decent, n_poor, _pp(n_good, total), _pp(n_decent, total), _pp(n_poor, total)]
+            for src, total, n_good, n_decent, n_poor in rows]
+    report_text = tabulate(rows, headers=headers, tablefmt='tsv')
+    dump_text(report_text, str(persist_dir / 'report.tsv'))
+
+
+def dump_decent_xyz(ancestor: str, decent_xyz_files: List[str], persist_dir: Path):
+    """
+    Merge the decent structures of the same ancestor into `system/<ancestor>/decent.xyz`.
+    """
+    if not decent_xyz_files:
+        print(f'no decent files for ancestor {ancestor}')
+        return
+    result_dir: Path = persist_dir / 'system' / ancestor
+    result_dir.mkdir(parents=True, exist_ok=True)
+
+    # merge xyz files, use cat for the sake of performance
+    os.system(f'cat {" ".join(decent_xyz_files)} > {result_dir / "decent.xyz"}')
+    dump_text(ancestor, str(result_dir / 'ANCESTOR'))
+
+
+ModelDeviStats = namedtuple('ModelDeviStats', ['total', 'n_good', 'n_poor', 'decent_indices'])
+
+
+def read_model_devi(model_devi_file, metric: str, lo: float, hi: float, chunksize: int = 100_000):
+    """
+    Classify the frames of model_devi.out by the metric in a streaming way,
+    so that the memory usage won't grow with the length of trajectory.
+
+    A frame is good if metric < lo, decent if lo <= metric < hi, otherwise poor.
+
+    :param model_devi_file: path of model_devi.out, the first line is the header starts with '#'
+    :param metric: the column used to classify frames
+    :param lo: lower bound of decent range
+    :param hi: upper bound of decent range
+    :param chunksize: number of lines to read at a time
+    :return: the counts of frames and the indices of decent frames
+    """
+    import pandas as pd
+
+    with open(model_devi_file, 'r') as f:
+        columns = f.readline().lstrip('#').split()
+    assert metric in columns, f'column {metric} is not found in {model_devi_file}'
+
+    total, n_good, n_poor = 0, 0, 0
+    decent_indices = []
+    reader = pd.read_csv(model_devi_file, sep=r'\s+', header=None, skiprows=1, comment='#',
+                         usecols=[columns.index(metric)], dtype=np.float64, chunksize=chunksize)
+    for chunk in reader:
+        values = chunk.iloc[:, 0].to_numpy()
+        n_good += int(np.count_nonzero(values < lo))
+        n_poor += int(np.count_nonzero(values >= hi))
+        decent_indices.append(np.flatnonzero((values >= lo) & (values < hi)) + total)
+        total += len(values)
+    decent = np.concatenate(decent_indices).tolist() if decent_indices else []
+    return ModelDeviStats(total=total, n_good=n_good, n_poor=n_poor, decent_indices=decent)
 
 
 def get_lammpstrj_frame_no(filename):
@@ -139,7 +224,7 @@ def get_lammpstrj_frame_no(filename):
     return int(m.group(1))
 
 
-def provision_model_devi(builder: DFlowBuilder, ns: str, /,
+def provision_model_devi(builder: 'DFlowBuilder', ns: str, /,
                          config: ModelDeviConfig,
                          executor: ExecutorConfig,
                          python_app: PythonApp,
@@ -148,15 +233,45 @@ def provision_model_devi(builder: DFlowBuilder, ns: str, /,
                          explore_app: ExploreApp,
                          explore_data_url: str,
                          persist_data_url: str,
+                         explore_slices: Any = None,
                          ):
+    """
+    :param explore_slices: the slices published by the setup step of explore, e.g. `SetupTasksResult.slices`,
+        the screening is sharded by them if concurrency is greater than 1,
+        so that each item only downloads the outputs of its own slice.
+    """
     run_tasks_fn = RunModelDeviTasksFn(config, workers=python_app.max_worker,
                                        type_map=type_map, explore_app=explore_app)
+    if config.concurrency <= 1 or explore_slices is None:
+        run_tasks_step = builder.make_python_step(run_tasks_fn, uid=f'{ns}-run-task',
+                                                  setup_script=python_app.setup_script,
+                                                  executor=create_dispatcher(executor, python_app.resource))(
+            RunModelDeviTasksArgs(
+                explore_dir=explore_data_url,
+                persist_dir=persist_data_url,
+            )
+        )
+        builder.add_step(run_tasks_step)
+        return
+
     run_tasks_step = builder.make_python_step(run_tasks_fn, uid=f'{ns}-run-task',
                                               setup_script=python_app.setup_script,
+                                              with_param=explore_slices,
                                               executor=create_dispatcher(executor, python_app.resource))(
         RunModelDeviTasksArgs(
-            explore_dir=explore_data_url,
+            # each item only download the outputs of its own slice
+            explore_dir=f'{explore_data_url}/slices/{{{{item}}}}',
+            persist_dir=f'{persist_data_url}/shards/{{{{item}}}}',
+            explore_slice='slices/{{item}}',
+        )
+    )
+    merge_shards_step = builder.make_python_step(MergeModelDeviShardsFn(), uid=f'{ns}-merge-shards',
+                                                 setup_script=python_app.setup_script,
+                                                 executor=create_dispatcher(executor, python_app.resource))(
+        MergeModelDeviShardsArgs(
+            shards_dir=f'{persist_data_url}/shards',
             persist_dir=persist_data_url,
         )
     )
     builder.add_step(run_tasks_step)
+    builder.add_step(merge_shards_step)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Any
 from copy import deepcopy
 
 from ai2_kit.core.util import load_yaml_files, merge_dict
@@ -19,6 +19,7 @@ class RuntimeContext:
 
     explore_url: Optional[str] = None
     explore_app: ExploreApp
+    explore_slices: Any = None
 
     screen_url: Optional[str] = None
 
@@ -26,18 +27,21 @@ class RuntimeContext:
     label_app: Optional[LabelApp] = None
 
 
-def run_tesla(*config_files: str, s3_prefix: str, debug: bool = False, skip: bool = False, max_iters: int = 1):
-    builder = build_tesla_workflow(*config_files, s3_prefix=s3_prefix, debug=debug, skip=skip, max_iters=max_iters)
+def run_tesla(*config_files: str, s3_prefix: str, debug: bool = False, skip: bool = False, max_iters: int = 1,
+              memoize: bool = False):
+    builder = build_tesla_workflow(*config_files, s3_prefix=s3_prefix, debug=debug, skip=skip, max_iters=max_iters,
+                                   memoize=memoize)
     builder.run()
 
 
-def build_tesla_workflow(*config_files: str, s3_prefix: str, debug: bool = False, skip: bool = False, max_iters: int = 1):
+def build_tesla_workflow(*config_files: str, s3_prefix: str, debug: bool = False, skip: bool = False, max_iters: int = 1,
+                         memoize: bool = False):
     config_raw = load_yaml_files(*config_files)
     config = TeslaConfig(**config_raw)
     config.init()
 
     builder = DFlowBuilder(name='tesla', s3_prefix=s3_prefix, debug=debug,
-                           default_archive=None)
+                           default_archive=None, memoize=memoize)
     step_switch = StepSwitch(skip)
     runtime_ctx = RuntimeContext()
 
@@ -68,9 +72,10 @@ def build_tesla_workflow(*config_files: str, s3_prefix: str, debug: bool = False
                     assert cp2k_cfg.init_systems, 'init_systems should not be empty for first iteration'
                     assert runtime_ctx.screen_url is None, f'explore_url should be None for iter 0, actual: {runtime_ctx.screen_url}'
 
-                for sys_key in cp2k_cfg.init_systems:
-                    sys = not_none(config.datasets[sys_key])
-                    builder.s3_upload(sys.url, f'init-systems/{sys_key}', cache=True)
+                builder.s3_upload_many([
+                    (not_none(config.datasets[sys_key]).url, f'init-systems/{sys_key}')
+                    for sys_key in cp2k_cfg.init_systems
+                ], cache=True)
                 cp2k.provision_cp2k(builder, step_name,
                                     config=cp2k_cfg,
                                     executor=cp2k_executor,
@@ -87,13 +92,15 @@ def build_tesla_workflow(*config_files: str, s3_prefix: str, debug: bool = False
         deepmd_cfg = workflow_cfg.train.deepmd
         if deepmd_cfg:
             step_name = f'train-deepmd-iter-{iter_str}'
+            previous_train_url = runtime_ctx.train_url
             runtime_ctx.train_url = f's3://./train-deepmd/iter/{iter_str}'
             deepmd_executor = not_none(config.executors[not_none(config.orchestration.deepmd)])
 
             if not step_switch.shall_skip(step_name):
-                for ds_key in deepmd_cfg.init_dataset:
-                    ds = not_none(config.datasets[ds_key])
-                    builder.s3_upload(ds.url, f'init-dataset/{ds_key}', cache=True)  # set cache to avoid re-upload
+                builder.s3_upload_many([
+                    (not_none(config.datasets[ds_key]).url, f'init-dataset/{ds_key}')
+                    for ds_key in deepmd_cfg.init_dataset
+                ], cache=True)  # set cache to avoid re-upload
                 deepmd.provision_deepmd(builder, step_name,
                                         config=deepmd_cfg,
                                         executor=deepmd_executor,
@@ -107,7 +114,8 @@ def build_tesla_workflow(*config_files: str, s3_prefix: str, debug: bool = False
                                         iter_dataset_url='s3://./iter-dataset',
                                         work_dir_url=runtime_ctx.train_url,
                                         iter_str=iter_str,
-                                        type_map=type_map)
+                                        type_map=type_map,
+                                        previous_train_url=previous_train_url)
 
         else:
             raise ValueError('No training app specified')
@@ -118,26 +126,28 @@ def build_tesla_workflow(*config_files: str, s3_prefix: str, debug: bool = False
             step_name = f'explore-lammps-iter-{iter_str}'
             runtime_ctx.explore_url = f's3://./explore-lammps/iter/{iter_str}'
             runtime_ctx.explore_app = 'lammps'
+            runtime_ctx.explore_slices = None
 
             lammps_executor = not_none(config.executors[not_none(config.orchestration.lammps)])
 
             if not step_switch.shall_skip(step_name):
-                for sys_key in lammps_cfg.systems:
-                    sys = not_none(config.datasets[sys_key])
-                    builder.s3_upload(sys.url, f'explore-systems/{sys_key}', cache=True)
-
-                lammps.provision_lammps(builder, step_name,
-                                        config=lammps_cfg,
-                                        executor=lammps_executor,
-                                        lammps_app=not_none(lammps_executor.apps.lammps),
-                                        python_app=not_none(lammps_executor.apps.python),
-
-                                        mlp_model_url=runtime_ctx.train_url,
-                                        systems_url='s3://./explore-systems',
-                                        work_dir_url=runtime_ctx.explore_url,
-                                        type_map=type_map,
-                                        mass_map=mass_map,
-                                        systems=config.datasets)
+                builder.s3_upload_many([
+                    (not_none(config.datasets[sys_key]).url, f'explore-systems/{sys_key}')
+                    for sys_key in lammps_cfg.systems
+                ], cache=True)
+
+                runtime_ctx.explore_slices = lammps.provision_lammps(builder, step_name,
+                                                                     config=lammps_cfg,
+                                                                     executor=lammps_executor,
+                                                                     lammps_app=not_none(lammps_executor.apps.lammps),
+                                                                     python_app=not_none(lammps_executor.apps.python),
+
+                                                                     mlp_model_url=runtime_ctx.train_url,
+                                                                     systems_url='s3://./explore-systems',
+                                                                     work_dir_url=runtime_ctx.explore_url,
+                                                                     type_map=type_map,
+                                                                     mass_map=mass_map,
+                                                                     systems=config.datasets)
         else:
             raise ValueError('No explore app specified')
 
@@ -156,6 +166,7 @@ def build_tesla_workflow(*config_files: str, s3_prefix: str, debug: bool = False
 
                                                 explore_app=runtime_ctx.explore_app,
                                                 explore_data_url=runtime_ctx.explore_url,
+                                                explore_slices=runtime_ctx.explore_slices,
 
                                                 persist_data_url=runtime_ctx.screen_url,
                                                 type_map=type_map)
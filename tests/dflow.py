@@ -128,6 +128,352 @@ echo "{args.v}"
         ret = dflow_builder.bash_build_template(foo, base_dir='/tmp/dflow-galaxy')
         print(ret.source)
 
+    def test_python_pkg_cache(self):
+        import tempfile
+        import tarfile
+        import dflow
+        import os
+        from unittest import mock
+
+        cwd, mode = os.getcwd(), dflow.config['mode']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                builder = dflow_builder.DFlowBuilder('test', s3_prefix='s3/test', debug=True,
+                                                     cache_dir=os.path.join(tmp_dir, 'cache'))
+                key = builder._add_python_pkg('dflow_galaxy')
+                self.assertTrue(os.path.exists(key))
+
+                # a new builder should reuse the tarball in storage
+                builder = dflow_builder.DFlowBuilder('test', s3_prefix='s3/test', debug=True,
+                                                     cache_dir=os.path.join(tmp_dir, 'cache'))
+                with mock.patch.object(builder, 's3_upload') as s3_upload:
+                    self.assertEqual(builder._add_python_pkg('dflow_galaxy'), key)
+                    s3_upload.assert_not_called()
+
+                # the excluded data is shipped as a separate bundle
+                with tarfile.open(key, 'r:bz2') as tar_fp:
+                    names = tar_fp.getnames()
+                self.assertIn('dflow_galaxy/res/__init__.py', names)
+                self.assertFalse(any(name.startswith('dflow_galaxy/res/cp2k_data') for name in names))
+                data_key = builder._add_python_pkg('dflow_galaxy/res/cp2k_data')
+                with tarfile.open(data_key, 'r:bz2') as tar_fp:
+                    names = tar_fp.getnames()
+                self.assertIn('dflow_galaxy/res/cp2k_data', names)
+                self.assertTrue(all(name.startswith('dflow_galaxy/res/cp2k_data') for name in names))
+            finally:
+                os.chdir(cwd)
+                dflow.config['mode'] = mode
+
+    def test_python_in_process(self):
+        import tempfile
+        import subprocess as sp
+        import os
+
+        @dataclass(frozen=True)
+        class FooArgs:
+            x: types.InputParam[int]
+
+        @dataclass
+        class FooResult:
+            y: types.OutputParam[int]
+
+        def foo(args: FooArgs) -> FooResult:
+            if args.x < 0:
+                raise SystemExit(-args.x)
+            return FooResult(y=args.x * 2)
+
+        for in_process in (True, False):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                ret = dflow_builder.python_build_template(foo, base_dir=tmp_dir, python_cmd='python',
+                                                          in_process=in_process)
+                os.makedirs(os.path.dirname(ret.script_path))
+                with open(ret.script_path, 'w') as fp:
+                    fp.write(ret.fn_str)
+
+                def _run(x, ret=ret):
+                    script = ret.source.replace('{{inputs.parameters.x}}', str(x))
+                    return sp.run(['bash', '-c', script], stdout=sp.PIPE, stderr=sp.PIPE).returncode
+
+                self.assertEqual(_run(2), 0)
+                with open(os.path.join(tmp_dir, 'output-parameters', 'y')) as fp:
+                    self.assertEqual(fp.read(), '4')
+                self.assertEqual(_run(-3), 1)
+
+    def test_python_blob(self):
+        import tempfile
+        import subprocess as sp
+        import os
+
+        @dataclass(frozen=True)
+        class FooArgs:
+            x: types.InputParam[int]
+
+        @dataclass
+        class FooResult:
+            y: types.OutputParam[int]
+
+        class FooFn:
+            def __init__(self, table):
+                self.table = table
+                self.offset = 1
+
+            def __call__(self, args: FooArgs) -> FooResult:
+                return FooResult(y=self.table[args.x] + self.offset)
+
+        table = {i: i * 2 for i in range(10000)}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ret = dflow_builder.python_build_template(FooFn(table), base_dir=tmp_dir, python_cmd='python')
+            self.assertEqual(len(ret.blobs), 1)
+            # the same config should be offloaded to the same blob
+            ret_2 = dflow_builder.python_build_template(FooFn(dict(table)), base_dir=tmp_dir, python_cmd='python')
+            self.assertEqual(ret.blobs.keys(), ret_2.blobs.keys())
+
+            os.makedirs(ret.blob_dir)
+            with open(ret.script_path, 'w') as fp:
+                fp.write(ret.fn_str)
+            for blob_hash, blob in ret.blobs.items():
+                with open(os.path.join(ret.blob_dir, blob_hash), 'wb') as fp:
+                    fp.write(blob)
+            script = ret.source.replace('{{inputs.parameters.x}}', '3')
+            self.assertEqual(sp.run(['bash', '-c', script]).returncode, 0)
+            with open(os.path.join(tmp_dir, 'output-parameters', 'y')) as fp:
+                self.assertEqual(fp.read(), '7')
+
+        inlined = dflow_builder.python_build_template(FooFn(table), base_dir='/tmp/x', blob_min_size=None)
+        self.assertEqual(inlined.blobs, {})
+        self.assertLess(len(ret.fn_str) * 2, len(inlined.fn_str))
+
+    def test_share_template(self):
+        @dataclass(frozen=True)
+        class FooArgs:
+            x: types.InputParam[int]
+            y: types.InputArtifact
+            z: types.OutputArtifact
+
+        def foo(args: FooArgs):
+            return f'cp -r {args.y} {args.z} && echo {args.x}'
+
+        builder = dflow_builder.DFlowBuilder('test', s3_prefix='test')
+        steps = [
+            builder.make_bash_step(foo, uid=f'foo-{i}')(FooArgs(x=i, y='s3://./y', z=f's3://./z/{i}'))
+            for i in range(3)
+        ]
+        templates = set(id(step.df_step.template) for step in steps)
+        self.assertEqual(len(templates), 1)
+        save_keys = [step.df_step.inputs.parameters['__save_z__'].value for step in steps]
+        self.assertEqual(save_keys, ['test/z/0', 'test/z/1', 'test/z/2'])
+
+    def test_share_rendered_template(self):
+        from unittest import mock
+        from dflow.plugins.dispatcher import DispatcherExecutor
+
+        @dataclass(frozen=True)
+        class FooArgs:
+            x: types.InputParam[int]
+
+        def foo(args: FooArgs):
+            return f'echo {args.x}'
+
+        def _create_dispatcher():
+            # a new executor of the same config for each step, the same as create_dispatcher does
+            return DispatcherExecutor(host='hpc', username='user', remote_root='/data',
+                                      machine_dict={'batch_type': 'Slurm', 'context_type': 'SSHContext'},
+                                      resources_dict={'number_node': 1})
+
+        builder = dflow_builder.DFlowBuilder('test', s3_prefix='test')
+        for i in range(5):
+            builder.add_step(builder.make_bash_step(foo, uid=f'foo-{i}', executor=_create_dispatcher())(FooArgs(x=i)))
+        with mock.patch.object(DispatcherExecutor, 'render', autospec=True,
+                               side_effect=DispatcherExecutor.render) as render:
+            manifest = builder.workflow.to_dict()
+        self.assertEqual(render.call_count, 1)
+        templates = [t['name'] for t in manifest['spec']['templates'] if t['name'].startswith('bash-template')]
+        self.assertEqual(len(templates), 1)
+
+    def test_s3_upload_many(self):
+        import tempfile
+        import dflow
+        import os
+        from dflow_galaxy.core.storage import LocalStorageClient
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_dir = os.path.join(tmp_dir, 'data')
+            os.makedirs(os.path.join(data_dir, 'set.000'))
+            for i in range(20):
+                with open(os.path.join(data_dir, 'set.000', f'{i}.npy'), 'w') as fp:
+                    fp.write(str(i))
+            single_file = os.path.join(tmp_dir, 'single.txt')
+            with open(single_file, 'w') as fp:
+                fp.write('single')
+
+            client = LocalStorageClient(os.path.join(tmp_dir, 's3'))
+            storage_client = dflow.s3_config['storage_client']
+            dflow.s3_config['storage_client'] = client
+            try:
+                builder = dflow_builder.DFlowBuilder('test', s3_prefix='test')
+                keys = builder.s3_upload_many([(data_dir, 'dataset'), (single_file, 'single.txt')], max_workers=4)
+            finally:
+                dflow.s3_config['storage_client'] = storage_client
+            self.assertEqual(keys, ['test/dataset', 'test/single.txt'])
+            self.assertEqual(len(client.list('test/dataset/')), 20)
+            self.assertEqual(client.list('test/single.txt'), ['test/single.txt'])
+
+    def test_s3_upload_cache(self):
+        import tempfile
+        import dflow
+        import os
+        from unittest import mock
+        from dflow_galaxy.core import storage
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_dir = os.path.join(tmp_dir, 'data')
+            os.makedirs(data_dir)
+            with open(os.path.join(data_dir, 'a.txt'), 'w') as fp:
+                fp.write('a')
+
+            client = storage.LocalStorageClient(os.path.join(tmp_dir, 's3'))
+            storage_client = dflow.s3_config['storage_client']
+            dflow.s3_config['storage_client'] = client
+            try:
+                def _upload(cache_dir):
+                    builder = dflow_builder.DFlowBuilder('test', s3_prefix='test', cache_dir=cache_dir)
+                    with mock.patch.object(storage, 'upload_files', wraps=storage.upload_files) as upload_files:
+                        key = builder.s3_upload(data_dir, 'dataset', cache=True)
+                    self.assertEqual(key, 'test/dataset')
+                    return upload_files.call_count
+
+                # upload dataset and manifest
+                self.assertEqual(_upload(os.path.join(tmp_dir, 'cache-1')), 2)
+                # no upload even if the local cache is missing as the manifest is mirrored in storage
+                self.assertEqual(_upload(os.path.join(tmp_dir, 'cache-2')), 0)
+
+                with open(os.path.join(data_dir, 'a.txt'), 'w') as fp:
+                    fp.write('b')
+                self.assertEqual(_upload(os.path.join(tmp_dir, 'cache-1')), 2)
+            finally:
+                dflow.s3_config['storage_client'] = storage_client
+
+    def test_memoize_key(self):
+        import tempfile
+        import dflow
+        from dflow_galaxy.core.storage import LocalStorageClient
+
+        @dataclass(frozen=True)
+        class FooArgs:
+            x: types.InputParam[int]
+            y: types.InputArtifact
+            z: types.OutputArtifact
+
+        def foo(args: FooArgs):
+            return f'cp -r {args.y} {args.z} && echo {args.x}'
+
+        def _memo_keys(x):
+            builder = dflow_builder.DFlowBuilder('test', s3_prefix='test', memoize=True, cache_dir=tmp_dir)
+            make_foo = builder.make_bash_step(foo, uid='foo')
+            step_1 = make_foo(FooArgs(x=x, y='s3://./a', z='s3://./b'))
+            step_2 = make_foo(FooArgs(x=1, y=step_1.args.z, z='s3://./c'))
+            step_3 = make_foo(FooArgs(x=1, y='s3://./b', z='s3://./d'))
+            return [step.df_step.inputs.parameters['__memo_key__'].value for step in (step_1, step_2, step_3)]
+
+        storage_client = dflow.s3_config['storage_client']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dflow.s3_config['storage_client'] = LocalStorageClient(tmp_dir)
+            try:
+                keys_1, keys_2 = _memo_keys(1), _memo_keys(2)
+                self.assertEqual(keys_1, _memo_keys(1))
+            finally:
+                dflow.s3_config['storage_client'] = storage_client
+        # the change of upstream step should invalidate downstream steps
+        for k1, k2 in zip(keys_1, keys_2):
+            self.assertNotEqual(k1, k2)
+
+    def test_local_executor(self):
+        import tempfile
+        import dflow
+        import os
+        from unittest import mock
+
+        @dataclass(frozen=True)
+        class SplitArgs:
+            n: types.InputParam[int]
+
+        @dataclass
+        class SplitResult:
+            items: types.OutputParam[list]
+
+        def split(args: SplitArgs) -> SplitResult:
+            return SplitResult(items=[f'item-{i}' for i in range(args.n)])
+
+        @dataclass(frozen=True)
+        class EchoArgs:
+            name: types.InputParam[str]
+            output_dir: types.OutputArtifact
+
+        def echo(args: EchoArgs):
+            return f'mkdir -p {args.output_dir} && echo {args.name} > {args.output_dir}/{args.name}.txt'
+
+        def fail(args: EchoArgs):
+            return 'exit 1'
+
+        @dataclass(frozen=True)
+        class TouchArgs:
+            input_dir: types.InputArtifact
+            output_dir: types.OutputArtifact
+
+        def touch(args: TouchArgs):
+            return f'touch {args.input_dir}/touched && cp -r {args.input_dir} {args.output_dir}'
+
+        from dflow.step import ArgoRange, ArgoLen
+
+        cwd, mode = os.getcwd(), dflow.config['mode']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                builder = dflow_builder.DFlowBuilder('test', s3_prefix='s3/test', debug=True, debug_runner='local',
+                                                     cache_dir=os.path.join(tmp_dir, 'cache'))
+                split_step = builder.make_python_step(split, uid='split', pkgs=['dflow_galaxy'])(SplitArgs(n=4))
+                fan_out_step = builder.make_bash_step(echo, uid='fan-out', with_param=split_step.result.items)(
+                    EchoArgs(name='{{item}}', output_dir='s3://./fan-out'))
+                parallel_steps = [
+                    builder.make_bash_step(echo, uid=f'parallel-{i}')(EchoArgs(name=f'parallel-{i}', output_dir='s3://./parallel'))
+                    for i in range(2)
+                ]
+                # argo_range out of debug mode, whose end is the length of an output parameter
+                range_step = builder.make_bash_step(echo, uid='range',
+                                                    with_param=ArgoRange(ArgoLen(split_step.result.items), 1))(
+                    EchoArgs(name='range-{{item}}', output_dir='s3://./range'))
+                builder.add_step(split_step)
+                builder.add_step(fan_out_step)
+                builder.add_steps(parallel_steps)
+                builder.add_step(range_step)
+                # a task that writes to its inputs should not modify the artifacts of upstream steps
+                touch_step = builder.make_bash_step(touch, uid='touch')(
+                    TouchArgs(input_dir='s3://./parallel', output_dir='s3://./touch'))
+                builder.add_step(touch_step)
+                pkg_cache_dir = os.path.join(tmp_dir, 'pkg-cache')
+                with mock.patch.dict(os.environ, {dflow_builder.PKG_CACHE_DIR_ENV: pkg_cache_dir}), \
+                        mock.patch.dict(dflow.config, {'debug_copy_method': 'copy'}):
+                    builder.run()
+
+                self.assertEqual(sorted(os.listdir('s3/test/fan-out')), [f'item-{i}.txt' for i in range(4)])
+                self.assertEqual(sorted(os.listdir('s3/test/parallel')), ['parallel-0.txt', 'parallel-1.txt'])
+                self.assertEqual(sorted(os.listdir('s3/test/range')), [f'range-{i}.txt' for i in range(1, 4)])
+                self.assertIn('touched', os.listdir('s3/test/touch'))
+                # packages are extracted into the cache
+                env_dirs = os.listdir(pkg_cache_dir)
+                self.assertEqual(len(env_dirs), 1)
+                self.assertTrue(os.path.isdir(os.path.join(pkg_cache_dir, env_dirs[0], 'dflow_galaxy')))
+
+                failed_step = builder.make_bash_step(fail, uid='failed')(
+                    EchoArgs(name='failed', output_dir='s3://./failed'))
+                builder.add_step(failed_step)
+                with self.assertRaises(RuntimeError):
+                    builder.run()
+            finally:
+                os.chdir(cwd)
+                dflow.config['mode'] = mode
+
 
 if __name__ == '__main__':
     unittest.main()
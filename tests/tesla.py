@@ -15,7 +15,6 @@ class TestTesla(unittest.TestCase):
             context=deepmd_app,
         )
         bash_script = step(deepmd.RunDeepmdTrainingArgs(
-            slice_idx='{{item}}',
             init_dataset_dir='init-dataset',
             iter_dataset_dir='iter-dataset',
             work_dir='task_dir',
@@ -23,10 +22,508 @@ class TestTesla(unittest.TestCase):
         ))
         print(ensure_str(bash_script))
 
+    def test_deepmd_warm_start(self):
+        import tempfile
+        import subprocess as sp
+        import shlex
+        import os
+
+        step = deepmd.RunDeepmdTrainingFn(config=deepmd.DeepmdConfig(warm_start=True),
+                                          context=deepmd.DeepmdApp(resource=Resource()), warm_start=True)
+        self.assertIn('dp train input.json --init-frz-model $INIT_MODEL', step._build_dp_train_script())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            def _run(item, script):
+                script = '\n'.join(['set -e', f'cd {tmp_dir}', f'ITEM={item}', f'PERSIST_DIR={tmp_dir}/$ITEM/persist',
+                                     *script])
+                return sp.check_output(f'bash -c {shlex.quote(script)}', shell=True).decode().strip()
+
+            # only the model that can initialize training is kept apart from checkpoints and logs
+            for item, models in [('tasks/000/', ['frozen_model.pb']),
+                                 ('tasks/001/', ['original_model.pb', 'frozen_model.pb'])]:
+                os.makedirs(f'{tmp_dir}/{item}/persist')
+                for model in [*models, 'model.ckpt.index', 'lcurve.out']:
+                    open(f'{tmp_dir}/{item}/persist/{model}', 'w').close()
+                _run(item, step._build_persist_model_script(f'{tmp_dir}/prev'))
+            self.assertEqual(os.listdir(f'{tmp_dir}/prev/models/tasks/000'), ['frozen_model.pb'])
+            self.assertEqual(os.listdir(f'{tmp_dir}/prev/models/tasks/001'), ['original_model.pb'])
+
+            def _init_model(item):
+                return _run(item, [*step._build_init_model_script(f'{tmp_dir}/prev/models'), 'echo $INIT_MODEL'])
+
+            self.assertEqual(_init_model('tasks/000/'), f'{tmp_dir}/prev/models/tasks/000//frozen_model.pb')
+            self.assertEqual(_init_model('tasks/001/'), f'{tmp_dir}/prev/models/tasks/001//original_model.pb')
+            with self.assertRaises(sp.CalledProcessError):
+                _init_model('tasks/002/')
+
+    def test_deepmd_restart(self):
+        import tempfile
+        import subprocess as sp
+        import shlex
+        import time
+        import os
+
+        step = deepmd.RunDeepmdTrainingFn(config=deepmd.DeepmdConfig(),
+                                          context=deepmd.DeepmdApp(resource=Resource(), dp_cmd='echo dp',
+                                                                   checkpoint_interval=10))
+        self.assertIn('SYNC_CKPT_PID=$!', step._build_sync_checkpoint_script())
+        # the checkpoints are not persisted along with the models once the training is done
+        script = ensure_str(step(deepmd.RunDeepmdTrainingArgs(init_dataset_dir='init-dataset',
+                                                              iter_dataset_dir='iter-dataset',
+                                                              work_dir='task_dir', persist_dir='output_dir')))
+        self.assertLess(script.index('rm -f model.ckpt* checkpoint $PERSIST_DIR/model.ckpt*'),
+                        script.index('mv *.* $PERSIST_DIR'))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the sync loop should be stopped with its sleep, or it will hold the output until it wakes up
+            script = '\n'.join(['set -e', f'cd {tmp_dir}', f'PERSIST_DIR={tmp_dir}/persist',
+                                 *step._build_sync_checkpoint_script(),
+                                 'sleep 1',
+                                 step._build_stop_sync_checkpoint_script(),
+                                 'echo stopped'])
+            output = sp.run(['bash', '-c', script], stdout=sp.PIPE, timeout=30).stdout
+            self.assertEqual(output.decode().strip(), 'stopped')
+            for _ in range(50):  # the sleep should be killed along with the loop
+                if 'sleep 600' not in sp.run(['ps', '-eo', 'args'], stdout=sp.PIPE).stdout.decode():
+                    break
+                time.sleep(0.1)
+            else:
+                self.fail('the sleep of sync loop is not killed')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            def _train():
+                script = '\n'.join(['set -e', f'cd {tmp_dir}', step._build_dp_train_script()])
+                # only check the train command as there is no model to freeze
+                output = sp.run(f'bash -c {shlex.quote(script)}', shell=True, stdout=sp.PIPE).stdout
+                return output.decode().splitlines()[0]
+
+            self.assertEqual(_train(), 'dp train input.json')
+            os.remove(f'{tmp_dir}/dp-train.done')
+            # restart from checkpoint if training was interrupted
+            open(f'{tmp_dir}/checkpoint', 'w').close()
+            self.assertEqual(_train(), 'dp train input.json --restart model.ckpt')
+
+
+    def test_parsed_cp2k_cache(self):
+        import tempfile
+        import shutil
+        import os
+        import numpy as np
+        import dpdata
+
+        dp_sys = dpdata.LabeledSystem(data={
+            'atom_names': ['O', 'H'], 'atom_numbs': [1, 2], 'atom_types': np.array([0, 1, 1]),
+            'orig': np.zeros(3), 'cells': np.eye(3)[None] * 10, 'coords': np.random.rand(1, 3, 3),
+            'energies': np.array([1.0]), 'forces': np.random.rand(1, 3, 3), 'nopbc': False,
+        })
+        fn = deepmd.UpdateDatasetFn(config=deepmd.DeepmdConfig(), iter_str='000', label_app='cp2k', type_map=['O', 'H'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            label_dir = os.path.join(tmp_dir, 'label')
+            parsed_dir = os.path.join(tmp_dir, 'parsed')
+            cp2k_dir = os.path.join(label_dir, 'tasks', '000000', 'persist')
+            os.makedirs(cp2k_dir)
+            for name, text in [('ANCESTOR', 'h2o'), ('output', 'not a valid cp2k output')]:
+                with open(os.path.join(cp2k_dir, name), 'w') as fp:
+                    fp.write(text)
+            _ancestor, empty_sys, error = fn._parse_cp2k_dir(cp2k_dir, label_dir, parsed_dir)
+            self.assertIsNone(error)
+            self.assertEqual(len(empty_sys), 0)
+            # the cache is written to parsed_dir instead of the label dir
+            cache_file = os.path.join(parsed_dir, 'tasks', '000000', 'persist', deepmd.PARSED_CACHE)
+            self.assertTrue(os.path.exists(cache_file))
+            self.assertNotIn(deepmd.PARSED_CACHE, os.listdir(cp2k_dir))
+
+            # the cached result should be used instead of parsing the output
+            output_file = os.path.join(cp2k_dir, 'output')
+            deepmd._dump_parsed_cache(cache_file, output_file, dp_sys, ['O', 'H'])
+            ancestor, cached_sys, error = fn._parse_cp2k_dir(cp2k_dir, label_dir, parsed_dir)
+            self.assertIsNone(error)
+            self.assertEqual(ancestor, 'h2o')
+            self.assertEqual(cached_sys.data['atom_names'], ['O', 'H'])
+            self.assertTrue(np.allclose(cached_sys.data['forces'], dp_sys.data['forces']))
+            # the cache is invalid if the type map or the output is changed
+            self.assertIsNone(deepmd._load_parsed_cache(cache_file, output_file, ['H', 'O']))
+            with open(output_file, 'a') as fp:
+                fp.write('changed')
+            self.assertIsNone(deepmd._load_parsed_cache(cache_file, output_file, ['O', 'H']))
+
+            # the cache of the previous run is persisted with the parsed dir
+            dataset_dir = os.path.join(tmp_dir, 'iter-dataset')
+            deepmd._dump_parsed_cache(cache_file, output_file, dp_sys, ['O', 'H'])
+            shutil.move(parsed_dir, os.path.join(tmp_dir, 'prev-parsed'))
+            fn(deepmd.UpdateDatasetArgs(label_dir=label_dir, iter_dataset_dir=dataset_dir, parsed_dir=parsed_dir,
+                                        prev_parsed_dir=os.path.join(tmp_dir, 'prev-parsed')))
+            self.assertTrue(os.path.exists(cache_file))
+            self.assertIn('h2o', os.listdir(os.path.join(dataset_dir, '000')))
+
+    def test_setup_deepmd_tasks(self):
+        import tempfile
+        import subprocess as sp
+        import json
+        import os
+        import numpy as np
+        import dpdata
+
+        dp_sys = dpdata.LabeledSystem(data={
+            'atom_names': ['O', 'H'], 'atom_numbs': [1, 2], 'atom_types': np.array([0, 1, 1]),
+            'orig': np.zeros(3), 'cells': np.eye(3)[None] * 10, 'coords': np.random.rand(1, 3, 3),
+            'energies': np.array([1.0]), 'forces': np.random.rand(1, 3, 3), 'nopbc': False,
+        })
+        config = deepmd.DeepmdConfig(model_num=2, input_template={
+            'model': {'descriptor': {'type': 'se_e2_a'}, 'fitting_net': {}}, 'training': {},
+        })
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                cp2k_dir = os.path.join('label', 'tasks', '000000', 'persist')
+                os.makedirs(cp2k_dir)
+                os.makedirs('init-data')
+                for name, text in [('ANCESTOR', 'h2o'), ('output', 'cp2k output')]:
+                    with open(os.path.join(cp2k_dir, name), 'w') as fp:
+                        fp.write(text)
+                deepmd._dump_parsed_cache(os.path.join('parsed', 'tasks', '000000', 'persist', deepmd.PARSED_CACHE),
+                                          os.path.join(cp2k_dir, 'output'), dp_sys, ['O', 'H'])
+                deepmd.UpdateDatasetFn(config=config, iter_str='000', label_app='cp2k', type_map=['O', 'H'])(
+                    deepmd.UpdateDatasetArgs(label_dir='label', iter_dataset_dir='iter-data', parsed_dir='parsed'))
+                self.assertIn(deepmd.DATASET_MANIFEST, os.listdir('iter-data/000'))
+
+                # the cold cache is filled by the setup step
+                result = deepmd.SetupDeepmdTaskFn(config, type_map=['O', 'H'], concurrency=1,
+                                                  dataset_cache_dir=f'{tmp_dir}/cache')(
+                    deepmd.SetupDeepmdTasksArgs(init_dataset_dir='init-data', iter_dataset_dir='iter-data',
+                                                work_dir='train'))
+                self.assertEqual(result.slices, ['0'])
+                # the manifest is not a dataset
+                for task in ['000', '001']:
+                    with open(f'train/slices/0/tasks/{task}/input.json') as fp:
+                        systems = json.load(fp)['training']['training_data']['systems']
+                    self.assertEqual(systems, ['./iter-dataset/000/h2o'])
+
+                # so that the training tasks can link the datasets of previous iterations without downloading them
+                script = '\n'.join(['set -e', 'cd train/slices/0',
+                                     deepmd.bash_sync_dataset_cache('no-iter-dataset', f'{tmp_dir}/cache',
+                                                                    deepmd.DATASET_INDEX, 'links')])
+                sp.check_output(['bash', '-c', script], stderr=sp.STDOUT)
+                self.assertTrue(os.path.isdir('train/slices/0/links/000/h2o/set.000'))
+            finally:
+                os.chdir(cwd)
+
+    def test_append_deepmd_npy(self):
+        import tempfile
+        import os
+        from pathlib import Path
+        import numpy as np
+        import dpdata
+
+        def _make_sys(atom_types, n_frames):
+            atom_types = np.array(atom_types)
+            return dpdata.LabeledSystem(data={
+                'atom_names': ['O', 'H'], 'atom_numbs': [int(sum(atom_types == 0)), int(sum(atom_types == 1))],
+                'atom_types': atom_types, 'orig': np.zeros(3), 'cells': np.stack([np.eye(3) * 10] * n_frames),
+                'coords': np.random.rand(n_frames, len(atom_types), 3), 'energies': np.ones(n_frames),
+                'forces': np.random.rand(n_frames, len(atom_types), 3), 'nopbc': False,
+            })
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset_dir = Path(tmp_dir) / 'h2o'
+            deepmd.append_deepmd_npy(_make_sys([0, 1, 1], 2), dataset_dir, type_map=['O', 'H'])
+            deepmd.append_deepmd_npy(_make_sys([1, 0, 1], 3), dataset_dir, type_map=['O', 'H'])
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['h2o'])
+            self.assertEqual(sorted(p.name for p in dataset_dir.glob('set.*')), ['set.000', 'set.001'])
+            dataset = dpdata.LabeledSystem(str(dataset_dir), fmt='deepmd/npy', type_map=['O', 'H'])
+            self.assertEqual(len(dataset), 5)
+
+            with self.assertRaises(AssertionError):
+                deepmd.append_deepmd_npy(_make_sys([0, 0, 1], 1), dataset_dir, type_map=['O', 'H'])
+
+    def test_sync_dataset_cache(self):
+        import tempfile
+        import subprocess as sp
+        import shlex
+        import os
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            keys = {}
+            for iter_str in ['000', '001']:
+                os.makedirs(f'{tmp_dir}/iter-dataset/{iter_str}/h2o/set.000')
+                with open(f'{tmp_dir}/iter-dataset/{iter_str}/h2o/type.raw', 'w') as fp:
+                    fp.write(iter_str)
+                keys[iter_str] = deepmd.dump_dataset_manifest(f'{tmp_dir}/iter-dataset/{iter_str}')
+            self.assertNotEqual(keys['000'], keys['001'])
+            with open(f'{tmp_dir}/index.lst', 'w') as fp:
+                fp.write(''.join(f'{key} {name}\n' for name, key in keys.items()))
+
+            def _sync(src_dir):
+                script = '\n'.join([
+                    'set -e',
+                    f'cd {tmp_dir}',
+                    deepmd.bash_sync_dataset_cache(src_dir, f'{tmp_dir}/cache', 'index.lst', 'links'),
+                ])
+                sp.check_output(f'bash -c {shlex.quote(script)}', shell=True, stderr=sp.STDOUT)
+
+            # only the dataset of the first iteration is cached
+            with self.assertRaises(sp.CalledProcessError):
+                _sync('iter-dataset/000')
+            self.assertEqual(os.listdir(f'{tmp_dir}/cache'), [keys['000']])
+
+            # the delta of the next iteration is synced
+            _sync('iter-dataset/001')
+            self.assertEqual(sorted(os.listdir(f'{tmp_dir}/cache')), sorted(keys.values()))
+            for name in keys:
+                with open(f'{tmp_dir}/links/{name}/h2o/type.raw') as fp:
+                    self.assertEqual(fp.read(), name)
+
+            # a dir of datasets is synced as well
+            _sync('iter-dataset')
+
+    def test_split_task_dirs(self):
+        import tempfile
+        import os
+        from dflow_galaxy.workflow.tesla.domain.lib import split_task_dirs, glob_task_dirs, dump_task_cost
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in range(5):
+                os.makedirs(os.path.join(tmp_dir, 'tasks', f'{i:06d}', 'persist'))
+            os.makedirs(os.path.join(tmp_dir, 'input_data'))
+            slices = split_task_dirs(tmp_dir, 3, shared_dirs=['input_data'])
+            self.assertEqual(slices, ['0', '1', '2'])
+
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['slices'])
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp_dir, 'slices', '0', 'tasks'))), ['000000', '000003'])
+            self.assertTrue(os.path.isdir(os.path.join(tmp_dir, 'slices', '2', 'input_data')))
+            self.assertEqual(len(glob_task_dirs(tmp_dir, 'persist')), 5)
+
+        # the number of slices should not exceed the number of tasks
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in range(2):
+                os.makedirs(os.path.join(tmp_dir, 'tasks', f'{i:06d}'))
+            self.assertEqual(split_task_dirs(tmp_dir, 3), ['0', '1'])
+        # one slice per task if concurrency is not positive
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in range(4):
+                os.makedirs(os.path.join(tmp_dir, 'tasks', f'{i:06d}'))
+            self.assertEqual(split_task_dirs(tmp_dir, 0), ['0', '1', '2', '3'])
+        # tasks should be balanced by their cost
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i, cost in enumerate([8, 1, 1, 3, 5]):
+                task_dir = os.path.join(tmp_dir, 'tasks', f'{i:06d}')
+                os.makedirs(task_dir)
+                dump_task_cost(task_dir, cost)
+            self.assertEqual(split_task_dirs(tmp_dir, 2), ['0', '1'])
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp_dir, 'slices', '0', 'tasks'))), ['000000', '000001'])
+        # each slice only gets the files referenced by its own tasks
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'input_data'))
+            task_files = {}
+            for i in range(4):
+                os.makedirs(os.path.join(tmp_dir, 'tasks', f'{i:06d}'))
+                data_file = os.path.join('input_data', f'h2o-{i % 3}.lammps.data')
+                open(os.path.join(tmp_dir, data_file), 'w').close()
+                task_files[f'{i:06d}'] = [data_file]
+            self.assertEqual(split_task_dirs(tmp_dir, 2, task_files=task_files), ['0', '1'])
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp_dir, 'slices', '0', 'input_data'))),
+                             ['h2o-0.lammps.data', 'h2o-2.lammps.data'])
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp_dir, 'slices', '1', 'input_data'))),
+                             ['h2o-0.lammps.data', 'h2o-1.lammps.data'])
 
     def test_get_lammpstraj_frame_no(self):
         self.assertEqual(model_devi.get_lammpstrj_frame_no('100.lammpstraj'), 100)
 
+    def test_lammpstrj_to_extxyz(self):
+        import tempfile
+        import os
+        import ase.io
+        import numpy as np
+        from dflow_galaxy.workflow.tesla.domain.lammpstrj import lammpstrj_to_extxyz
+
+        frames = [
+            ('xy xz yz pp pp pp', ['0.0 10.5 0.5', '0.0 10.0 0.0', '-0.2 10.0 -0.2'], 'x y z',
+             ['2 2 H 1.0 2.0 3.0 0.1 0.2 0.3', '1 1 O 0.5 0.5 0.5 -0.1 0.0 0.1', '3 2 H 4.0 5.0 6.0 0.0 0.0 0.0']),
+            ('pp pp ff', ['0.0 10.0', '0.0 10.0', '0.0 12.0'], 'xs ys zs',
+             ['1 1 O 0.1 0.2 0.3 0.0 0.0 0.0', '2 2 H 0.4 0.5 0.6 0.0 0.0 0.0', '3 2 H 0.7 0.8 0.9 0.0 0.0 0.0']),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trj_files = []
+            for i, (boundary, bounds, pos, atoms) in enumerate(frames):
+                trj_file = os.path.join(tmp_dir, f'{i}.lammpstrj')
+                with open(trj_file, 'w') as fp:
+                    fp.write('\n'.join([
+                        'ITEM: TIMESTEP', str(i * 100), 'ITEM: NUMBER OF ATOMS', str(len(atoms)),
+                        f'ITEM: BOX BOUNDS {boundary}', *bounds,
+                        f'ITEM: ATOMS id type element {pos} fx fy fz', *atoms,
+                    ]) + '\n')
+                trj_files.append(trj_file)
+            xyz_file = os.path.join(tmp_dir, 'decent.xyz')
+            self.assertEqual(lammpstrj_to_extxyz(trj_files, xyz_file, type_map=['O', 'H']), 2)
+
+            expected = [ase.io.read(f, 0, format='lammps-dump-text', specorder=['O', 'H']) for f in trj_files]
+            result = ase.io.read(xyz_file, ':', format='extxyz')
+        self.assertEqual(len(result), 2)
+        for a, b in zip(result, expected):
+            self.assertEqual(a.get_chemical_symbols(), b.get_chemical_symbols())
+            self.assertTrue(np.allclose(a.get_cell(), b.get_cell()))
+            self.assertTrue(np.allclose(a.get_positions(), b.get_positions()))
+            self.assertTrue(np.allclose(a.get_forces(), b.get_forces()))
+            self.assertEqual(a.pbc.tolist(), b.pbc.tolist())
+
+    def test_pack_lammpstrj(self):
+        import tempfile
+        import subprocess as sp
+        import os
+        from dflow_galaxy.workflow.tesla.domain import lammpstrj
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'traj'))
+            for frame_no in [0, 10, 100, 20]:
+                with open(os.path.join(tmp_dir, 'traj', f'{frame_no}.lammpstrj'), 'w') as fp:
+                    fp.write('\n'.join([
+                        'ITEM: TIMESTEP', str(frame_no), 'ITEM: NUMBER OF ATOMS', '1',
+                        'ITEM: BOX BOUNDS pp pp pp', '0.0 10.0', '0.0 10.0', '0.0 10.0',
+                        'ITEM: ATOMS id type x y z', f'1 1 {frame_no / 100} 0.0 0.0',
+                    ]) + '\n')
+            sp.check_call(['bash', '-c', lammpstrj.bash_pack_lammpstrj()], cwd=tmp_dir)
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'traj')))
+
+            index = lammpstrj.load_lammpstrj_index(os.path.join(tmp_dir, 'traj.idx'))
+            self.assertEqual(index[:, 0].tolist(), [0, 10, 20, 100])
+            frames = lammpstrj.iter_packed_lammpstrj(os.path.join(tmp_dir, 'traj.lammpstrj'),
+                                                     os.path.join(tmp_dir, 'traj.idx'), [3, 1])
+            self.assertEqual([frame.timestep for frame in frames], [100, 10])
+
+    def test_pack_outputs(self):
+        import tempfile
+        import subprocess as sp
+        import os
+        from dflow_galaxy.workflow.tesla.domain import lib
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            task_dir = os.path.join(tmp_dir, 'tasks', '000000')
+            persist_dir = os.path.join(task_dir, 'persist')
+            os.makedirs(persist_dir)
+            for name in ['cp2k.done', 'output', 'ANCESTOR']:
+                with open(os.path.join(task_dir, name), 'w') as fp:
+                    fp.write(name)
+            sp.check_call(['bash', '-c', lib.bash_persist_task('*.done output ANCESTOR', 'persist', pack=True)],
+                          cwd=task_dir)
+            self.assertEqual(os.listdir(persist_dir), [lib.TASK_ARCHIVE])
+
+            unpacked_dir = lib.unpack_persist_dir(persist_dir, tmp_dir, os.path.join(tmp_dir, 'unpacked'))
+            self.assertEqual(unpacked_dir, os.path.join(tmp_dir, 'unpacked', 'tasks', '000000', 'persist'))
+            self.assertEqual(sorted(os.listdir(unpacked_dir)), ['ANCESTOR', 'cp2k.done', 'output'])
+            # the persist dir should not be modified
+            self.assertEqual(os.listdir(persist_dir), [lib.TASK_ARCHIVE])
+
+            # restore the packed outputs to resume the task
+            for name in ['cp2k.done', 'output', 'ANCESTOR']:
+                os.remove(os.path.join(task_dir, name))
+            sp.check_call(['bash', '-c', lib.bash_restore_task()], cwd=task_dir)
+            self.assertEqual(sorted(os.listdir(task_dir)), ['ANCESTOR', 'cp2k.done', 'output', 'persist'])
+
+    def test_model_devi_shards(self):
+        import tempfile
+        import os
+
+        config = model_devi.ModelDeviConfig(decent_range=(0.1, 0.3))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            explore_dir = os.path.join(tmp_dir, 'explore')
+            for i, ancestor in enumerate(['h2o', 'h2o', 'nh3']):
+                # the sliced layout of explore tasks
+                persist_dir = os.path.join(explore_dir, 'slices', str(i // 2), 'tasks', f'{i:06d}', 'persist')
+                os.makedirs(os.path.join(persist_dir, 'traj'))
+                with open(os.path.join(persist_dir, 'ANCESTOR'), 'w') as fp:
+                    fp.write(ancestor)
+                with open(os.path.join(persist_dir, 'model_devi.out'), 'w') as fp:
+                    fp.write('# step max_devi_v min_devi_v avg_devi_v max_devi_f min_devi_f avg_devi_f\n')
+                    for step, v in enumerate([0.05, 0.2, 0.5]):
+                        fp.write(f'{step} 0 0 0 {v} 0 0\n')
+                        with open(os.path.join(persist_dir, 'traj', f'{step}.lammpstrj'), 'w') as trj_fp:
+                            trj_fp.write('\n'.join([
+                                'ITEM: TIMESTEP', str(step), 'ITEM: NUMBER OF ATOMS', '1',
+                                'ITEM: BOX BOUNDS pp pp pp', '0.0 10.0', '0.0 10.0', '0.0 10.0',
+                                'ITEM: ATOMS id type x y z', f'1 1 {i} 0.0 0.0',
+                            ]) + '\n')
+
+            def _run(fn, args, work_dir):
+                os.makedirs(work_dir)
+                cwd = os.getcwd()
+                os.chdir(work_dir)
+                try:
+                    fn(args)
+                finally:
+                    os.chdir(cwd)
+
+            # screen in a single step
+            fn = model_devi.RunModelDeviTasksFn(config, workers=1, type_map=['H'], explore_app='lammps')
+            output_dir = os.path.join(tmp_dir, 'output')
+            _run(fn, model_devi.RunModelDeviTasksArgs(explore_dir=explore_dir, persist_dir=output_dir),
+                 os.path.join(tmp_dir, 'work'))
+
+            # screen the slices in shards and merge them
+            shards_dir = os.path.join(tmp_dir, 'sharded', 'shards')
+            os.makedirs(shards_dir)
+            for shard in ['0', '1']:
+                _run(fn, model_devi.RunModelDeviTasksArgs(explore_dir=os.path.join(explore_dir, 'slices', shard),
+                                                          explore_slice=f'slices/{shard}',
+                                                          persist_dir=os.path.join(shards_dir, shard)),
+                     os.path.join(tmp_dir, f'work-{shard}'))
+            self.assertEqual(os.listdir(os.path.join(shards_dir, '0', 'system')), ['h2o'])
+            self.assertEqual(os.listdir(os.path.join(shards_dir, '1', 'system')), ['nh3'])
+            sharded_dir = os.path.join(tmp_dir, 'sharded')
+            _run(model_devi.MergeModelDeviShardsFn(),
+                 model_devi.MergeModelDeviShardsArgs(shards_dir=shards_dir, persist_dir=sharded_dir),
+                 os.path.join(tmp_dir, 'work-merge'))
+
+            for path in ['report.tsv', 'system/h2o/decent.xyz', 'system/nh3/decent.xyz', 'system/nh3/ANCESTOR']:
+                with open(os.path.join(output_dir, path)) as fp1, open(os.path.join(sharded_dir, path)) as fp2:
+                    self.assertEqual(sorted(fp1.read().splitlines()), sorted(fp2.read().splitlines()))
+
+    def test_read_model_devi(self):
+        import tempfile
+        import os
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_devi_file = os.path.join(tmp_dir, 'model_devi.out')
+            values = [0.01, 0.1, 0.2, 0.3, 0.05, 0.15, 0.5]
+            with open(model_devi_file, 'w') as fp:
+                fp.write('#       step         max_devi_v         min_devi_v         avg_devi_v'
+                         '         max_devi_f         min_devi_f         avg_devi_f\n')
+                for i, v in enumerate(values):
+                    fp.write(f'{i * 10:12d} 0.0 0.0 0.0 {v:.6e} 0.0 0.0\n')
+            # use a small chunk size to read the file in multiple chunks
+            stats = model_devi.read_model_devi(model_devi_file, 'max_devi_f', 0.1, 0.3, chunksize=3)
+        self.assertEqual(stats.total, 7)
+        self.assertEqual(stats.n_good, 2)
+        self.assertEqual(stats.n_poor, 2)
+        self.assertEqual(stats.decent_indices, [1, 2, 5])
+
+    def test_import_time(self):
+        import subprocess as sp
+        import sys
+        import re
+
+        def _import_time(*modules):
+            """:return: the cumulative import time in seconds of each imported module"""
+            cmd = [sys.executable, '-X', 'importtime', '-c', f'import {", ".join(modules)}']
+            stderr = sp.run(cmd, stderr=sp.PIPE, check=True).stderr.decode()
+            matches = re.findall(r'^import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)$', stderr, re.MULTILINE)
+            return {name: int(us) / 1e6 for us, name in matches}
+
+        # heavy dependencies should be imported by the functions that use them
+        heavy_modules = ['dpdata', 'pandas', 'ase', 'joblib', 'tabulate',
+                         'ai2_kit.domain.deepmd', 'ai2_kit.domain.lammps', 'ai2_kit.domain.cp2k']
+        domain_modules = [f'dflow_galaxy.workflow.tesla.domain.{m}' for m in ['deepmd', 'lammps', 'model_devi', 'cp2k']]
+        # the domain modules are imported when the functions of python steps are unpickled
+        imported = _import_time(*domain_modules)
+        for module in heavy_modules + ['dflow']:
+            self.assertNotIn(module, imported)
+        self.assertLess(sum(imported[m] for m in imported if m in domain_modules), 1.5)
+
+        imported = _import_time('dflow_galaxy.main', 'dflow_galaxy.workflow.tesla.main')
+        for module in heavy_modules:
+            self.assertNotIn(module, imported)
+        self.assertLess(imported['dflow_galaxy.workflow.tesla.main'], 3.0)
+
 
 
 
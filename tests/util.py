@@ -36,6 +36,60 @@ class TestUtil(unittest.TestCase):
             result = sp.check_output(f'bash -c {shlex.quote(script)}', shell=True)
             self.assertEqual(result.decode('utf-8').strip(), '\n'.join(['ITEM:0/', 'ITEM:1/']))
 
+    def test_bash_iter_ls_parallel(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            # the temp files of the loop should be removed
+            tmp_dir = os.path.join(tempdir, '.tmp')
+            os.makedirs(tmp_dir)
+            script = '\n'.join([
+                'set -e',
+                f'export TMPDIR={tmp_dir}',
+                f'cd {tempdir}',
+                f'ARGO_PROGRESS_FILE={tempdir}/progress',
+                f'mkdir -p {" ".join([str(i) for i in range(5)])}',
+                util.bash_iter_ls('*/', opt='-d', workers=3, script=[
+                    'sleep 0.2',
+                    util.bash_iter_lock('echo "ITEM:$ITEM" >> result'),
+                ]),
+            ])
+            sp.check_call(f'bash -c {shlex.quote(script)}', shell=True)
+            with open(f'{tempdir}/result') as fp:
+                self.assertEqual(sorted(fp.read().split()), [f'ITEM:{i}/' for i in range(5)])
+            with open(f'{tempdir}/progress') as fp:
+                self.assertEqual(fp.read().strip(), '5/5')
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+            # the loop should fail if any item failed
+            script = '\n'.join([
+                'set -e',
+                f'export TMPDIR={tmp_dir}',
+                f'cd {tempdir}',
+                f'ARGO_PROGRESS_FILE={tempdir}/progress',
+                util.bash_iter_ls('*/', opt='-d', workers=3, script='[ "$ITEM" != "2/" ]'),
+                'echo done',
+            ])
+            with self.assertRaises(sp.CalledProcessError):
+                sp.check_output(f'bash -c {shlex.quote(script)}', shell=True)
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_lpt_partition(self):
+        self.assertEqual(util.lpt_partition([1] * 5, 2), [[0, 2, 4], [1, 3]])
+        self.assertEqual(util.lpt_partition([8, 1, 1, 3, 5], 2), [[0, 1], [2, 3, 4]])
+        self.assertEqual(util.lpt_partition([1, 2], 3), [[1], [0], []])
+
+    def test_hash_path(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            os.makedirs(f'{tempdir}/a/b')
+            with open(f'{tempdir}/a/b/c.txt', 'w') as fp:
+                fp.write('hello')
+            h1 = util.hash_path(f'{tempdir}/a')
+            self.assertEqual(h1, util.hash_path(f'{tempdir}/a'))
+
+            with open(f'{tempdir}/a/b/c.pyc', 'w') as fp:
+                fp.write('binary')
+            self.assertNotEqual(h1, util.hash_path(f'{tempdir}/a'))
+            self.assertEqual(h1, util.hash_path(f'{tempdir}/a', include=lambda p: not p.endswith('.pyc')))
+
 
 if __name__ == '__main__':
     unittest.main()